@@ -1,55 +1,68 @@
 import streamlit as st
-from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageFilter, ImageEnhance, ImageChops
+from PIL import Image
 import io
-import zipfile
-import base64
 import textwrap
-import re
+import tempfile
+import uuid
 from functools import partial
+from promptmark.dedupe import NearDuplicateIndex
+from promptmark.export import EXPORT_PRESETS, OUTPUT_FORMATS, encode_image, export_batch, export_presets
+from promptmark.frames import get_frame_cache
+from promptmark.gallery import write_gallery_pages, write_html_table
+from promptmark.ingest import IngestCache, process_images
+from promptmark.render import process_image
+from promptmark.search import SearchIndex
+from promptmark.settings import DEFAULT_OVERLAY_SETTINGS, FONT_FILES
+from promptmark.store import get_store
+from promptmark.worker import RenderWorker
+from promptmark import trace
 
-default_overlay_settings = {
-    'font_path': "Lato-Regular.ttf", 
-    'font_size': 24,
-    'text_color': '#000000',
-    'wrap_width_percentage': 80,
-    'line_spacing_percentage': 100,
-    'stroke_width': 0,
-    'stroke_color': '#FFFFFF',
-    'tint': False,
-    'include_overlay': True,
-    'overlay_position': "Bottom",
-    'brightness': 0,
-    'uniform_padding_checkbox': False,
-    'uniform_padding': 3.0,
-    'vertical_padding': 3.0,
-    'horizontal_padding': 3.0,
-    'overlay_margin': 10,
-    'tint_color': '#FFFFFF',
-    'tint_opacity': 0.5
-}
-
-
-FONT_FILES = {
-    "Lato-Regular.ttf",
-    "Merriweather-Regular.ttf",
-    "Orbitron-SemiBold.ttf",
-    "Pacifico-Regular.ttf",
-    "PlayfairDisplaySC-Bold.ttf",
-    "Poppins-Bold.ttf"           
-}
+# Interactive renders run on a proxy this wide; full resolution is only rendered for downloads
+PREVIEW_WIDTH = 1200
+
+# Generated galleries stay in memory up to this size and spill to a temporary file beyond it
+GALLERY_SPOOL_BYTES = 16 * 1024 * 1024
+
+# Upper bound on thumbnails and metadata kept by the per-session ingest cache; images are read from the uploads when needed
+INGEST_CACHE_BUDGET_BYTES = 512 * 1024 * 1024
+
+# While a preview render is running, the displayed frame is checked this often
+RENDER_POLL_SECONDS = 0.2
+
+# Images listed per page of the selection list; only the current page's widgets and thumbnails are sent
+SELECTION_PAGE_SIZE = 20
 
 
 st.session_state['current_text'] = st.session_state.get('current_text', 'Select an image')
 
 if 'overlay_settings' not in st.session_state:
-    st.session_state.overlay_settings = default_overlay_settings.copy()
+    st.session_state.overlay_settings = DEFAULT_OVERLAY_SETTINGS.copy()
+
+# Identifies this session's decoded frames in the process-wide frame cache
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 if 'selected_image_info' not in st.session_state:
-    st.session_state.selected_image_info = {'image': None, 'text': None, 'filename': None}
+    st.session_state.selected_image_info = {'source': None, 'size': None, 'text': None, 'filename': None, 'key': None}
 
 if 'update_needed' not in st.session_state:
     st.session_state.update_needed = False    
 
+if 'render_layers' not in st.session_state:
+    st.session_state.render_layers = {}
+
+if 'render_worker' not in st.session_state:
+    st.session_state.render_worker = RenderWorker()
+
+if 'near_duplicates' not in st.session_state:
+    st.session_state.near_duplicates = NearDuplicateIndex()
+
+if 'search_index' not in st.session_state:
+    st.session_state.search_index = SearchIndex()
+
+if 'ingest_cache' not in st.session_state:
+    st.session_state.ingest_cache = IngestCache(INGEST_CACHE_BUDGET_BYTES)
+
 def create_layout():
     foo = st.container()
     with foo:
@@ -58,6 +71,7 @@ def create_layout():
         image_download_container =st.container()
         image_selection_container = st.container()
         html_generation_container = st.container()
+        batch_export_container = st.container()
         text_area_container = st.sidebar.container()
 
     return {
@@ -66,6 +80,7 @@ def create_layout():
         "image_download": image_download_container,
         "image_selection": image_selection_container,
         "html_generation": html_generation_container,
+        "batch_export": batch_export_container,
         "text_area": text_area_container
     }
 
@@ -119,9 +134,9 @@ def update_include_overlay():
 
 def handle_padding_update():
     # Use default values as fallbacks
-    default_vertical_padding = default_overlay_settings['vertical_padding']
-    default_horizontal_padding = default_overlay_settings['horizontal_padding']
-    default_uniform_padding = default_overlay_settings['uniform_padding']
+    default_vertical_padding = DEFAULT_OVERLAY_SETTINGS['vertical_padding']
+    default_horizontal_padding = DEFAULT_OVERLAY_SETTINGS['horizontal_padding']
+    default_uniform_padding = DEFAULT_OVERLAY_SETTINGS['uniform_padding']
 
     if st.session_state.uniform_padding_checkbox:
         # Update to non-uniform padding values
@@ -137,51 +152,116 @@ def handle_padding_update():
 
     st.session_state.update_needed = True
 
-def process_image(image, text, settings):    
-    expected_keys = ['font_path', 'font_size', 'text_color', 'wrap_width_percentage', 'stroke_width', 'stroke_color', 'overlay_position', 'brightness', 'vertical_padding', 'horizontal_padding', 'overlay_margin', 'tint_color', 'tint_opacity', 'line_spacing_percentage']
-    filtered_settings = {key: settings[key] for key in expected_keys if key in settings}
-    image_copy = image.copy()
-    if not settings['include_overlay']:
-        return add_watermark(image, user_name, settings['font_path'], 24, settings['text_color'], settings['overlay_position'])
-    
-    updated_image = overlay_text_on_image(image_copy, text, **filtered_settings)
-    if user_name:
-        updated_image = add_watermark(updated_image, user_name, filtered_settings['font_path'], 24, settings['text_color'], filtered_settings['overlay_position'])    
-    return updated_image
-
+def make_preview(image):
+    if image.width <= PREVIEW_WIDTH:
+        return image
+    return image.resize((PREVIEW_WIDTH, max(1, round(image.height * PREVIEW_WIDTH / image.width))), Image.LANCZOS, reducing_gap=2.0)
+
+def render_preview(preview, text, settings, watermark_text, layers, full_size, filename, cancelled):
+    # Runs on the render worker's thread, so it only touches its arguments and never st.session_state
+    with trace.trace('preview_render', filename=filename):
+        return process_image(preview, text, settings, watermark_text, layers, full_size, cancelled)
+
+def selected_frame(kind):
+    # Decoded pixels of the selected image live in the frame cache, which may drop them at any time;
+    # they are decoded again from the upload when that happened
+    info = st.session_state.selected_image_info
+    if kind == 'preview' and info['size'][0] <= PREVIEW_WIDTH:
+        kind = 'image'
+    if kind == 'preview':
+        load = lambda: make_preview(selected_frame('image'))
+    else:
+        load = lambda: load_image(info['source']).convert("RGB")
+    return get_frame_cache().get(st.session_state.session_id, kind, info['key'], load)
 
 def update_selected_image():
-    if st.session_state.update_needed and st.session_state.selected_image_info['image']:                
-        processed_image = process_image(
-            st.session_state.selected_image_info['image'],
+    if st.session_state.update_needed and st.session_state.selected_image_info['key'] is not None:
+        # Settings are copied, since the session's dict keeps changing while the render runs
+        st.session_state.render_worker.submit(
+            render_preview,
+            selected_frame('preview'),
             st.session_state.selected_image_info['text'],            
-            st.session_state.overlay_settings
+            dict(st.session_state.overlay_settings),
+            user_name,
+            st.session_state.render_layers,
+            st.session_state.selected_image_info['size'],
+            st.session_state.selected_image_info['filename']
         )        
-        # layout['image_display'].image(processed_image, caption="Current", use_column_width=True)
-        
-        st.session_state.processed_image = processed_image
         st.session_state.update_needed = False
 
+def show_processed_image(polling):
+    frame, _, error = st.session_state.render_worker.latest()
+    # Always display the latest completed frame, even while a newer one is rendering
+    if frame is not None:
+        st.image(frame, caption="Current", use_column_width=True)
+    if error is not None:
+        st.error(f"Rendering failed: {error}")
+    if st.session_state.render_worker.busy():
+        st.caption("Rendering...")
+    elif polling:
+        # The render finished; rerun the whole app once so polling stops
+        st.rerun()
+
 def update_text(data):
    st.session_state['current_text'] = data['description']
    st.session_state['selected_image_info'] = {
-       'image': data['image'].convert("RGB"),
+       'source': data['source'],
+       'size': None,
        'text': data['description'],
-       'filename': data['filename']
+       'filename': data['filename'],
+       'key': data['key']
    }
+   st.session_state.selected_image_info['size'] = selected_frame('image').size
    st.session_state['update_needed'] = True
    update_selected_image()
 
+def download_key():
+    info = st.session_state.selected_image_info
+    return (info['key'], info['text'], tuple(sorted(st.session_state.overlay_settings.items())), user_name)
+
+def request_download():
+    st.session_state.download_requested = download_key()
+
+def encode_options():
+    output_format = st.session_state.get('download_format', 'png')
+    presets = tuple(st.session_state.get('download_presets', ()))
+    if output_format == 'png':
+        return (output_format, None, st.session_state.get('download_compress_level', 6), st.session_state.get('download_optimize', False), presets)
+    return (output_format, st.session_state.get('download_quality', 90), None, st.session_state.get('download_optimize', False), presets)
+
 def prepare_download():
-    if 'processed_image' in st.session_state and st.session_state.processed_image is not None:
-        buffer = io.BytesIO()
-        st.session_state.processed_image.save(buffer, format='PNG')
-        buffer.seek(0)
-        filename = st.session_state.selected_image_info.get('filename', 'downloaded_image.png')
-        return buffer, f"overlay_{filename}"
-    else:
-        return None, None
+    # The preview is only a proxy, so the full-resolution render runs once a download is requested
+    # for the current image and settings. The encoded bytes are kept until either of them or the output
+    # options change, and the render itself in the frame cache for as long as it has room for it.
+    # With export sizes chosen, the download is a ZIP of the image at each of those sizes instead.
+    info = st.session_state.selected_image_info
+    if info['key'] is None or st.session_state.get('download_requested') != download_key():
+        return None, None, None
+    key = st.session_state.download_requested
+    options = encode_options()
+    stem = (info.get('filename') or 'downloaded_image.png').rsplit('.', 1)[0]
+    output_format, quality, compress_level, optimize, presets = options
+    if st.session_state.get('encoded_download', (None,))[0] != (key, options):
+        if presets:
+            archive = io.BytesIO()
+            with trace.trace('preset_export', presets=len(presets)):
+                export_presets(selected_frame('image'), info['text'], st.session_state.overlay_settings, user_name, archive,
+                               {name: EXPORT_PRESETS[name] for name in presets}, f"overlay_{stem}", output_format, quality, compress_level, optimize)
+            encoded, mime = archive.getvalue(), "application/zip"
+        else:
+            def render_full():
+                with trace.trace('full_render', filename=info['filename']):
+                    return process_image(selected_frame('image'), info['text'], st.session_state.overlay_settings, user_name)
+            full_render = get_frame_cache().get(st.session_state.session_id, 'full_render', key, render_full)
+            with trace.trace('encode', format=output_format):
+                encoded, mime = encode_image(full_render, output_format, quality, compress_level, optimize)
+        st.session_state.encoded_download = ((key, options), encoded, mime)
+    _, encoded, mime = st.session_state.encoded_download
+    return encoded, f"overlay_{stem}.{'zip' if presets else OUTPUT_FORMATS[output_format][2]}", mime
+
 
+def reset_selection_page():
+    st.session_state.selection_page = 1
 
 def select_and_display_image(data):
     pass
@@ -193,302 +273,9 @@ def update_temp_description():
     update_selected_image() 
 
 
-def adjust_brightness(input_img, brightness=0):
-    enhancer = ImageEnhance.Brightness(input_img)
-    # Brightness is a value between 0.0 (black image) and 2.0 or higher (increased brightness), with 1 being the original image
-    adjusted_img = enhancer.enhance(1 + brightness / 255)
-    return adjusted_img
-
-def add_color_tint(image, tint_color, opacity=0.5):
-    tint_layer = Image.new("RGBA", image.size, tint_color)
-    return ImageChops.blend(image, tint_layer, opacity)
-
-def create_html_table(image_data, custom_title):
-    # Start the HTML content with CSS
-    html_content = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-    <style>
-    body {
-        font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-        margin: 0;
-        padding: 0;
-        color: #333;
-        max-width: 1000px;
-        margin: auto;
-        box-sizing: border-box;
-    }
-    h1 {
-        text-align: center;
-        font-size: 24px;
-        margin-top: 50px;
-    }
-    table {
-        width: 100%;
-        border-collapse: collapse;
-        margin-top: 20px;
-        margin-bottom: 50px;
-    }
-    table, th, td {
-        border: 1px solid #ddd;
-    }
-    th, td {
-        text-align: left;
-        padding: 8px;
-    }
-    tr:nth-child(even) {
-        background-color: #f2f2f2;
-    }
-    img {
-        width: 100px;
-        height: auto;
-        object-fit: contain;
-    }
-    .selectable {
-        user-select: all; 
-        cursor: pointer;
-    }
-    @media print {
-        body {
-            color: #000;
-        }
-        table {
-            width: 100%;
-            border: 1px solid #000;
-        }
-        th, td {
-            border: 1px solid #000;
-            padding: 10px;
-        }
-    }
-    @media only screen and (max-width: 600px) {
-        body {
-            max-width: 100%;
-            padding: 10px;
-            font-size: 16px;
-        }
-        h1 {
-            font-size: 20px;
-            margin-top: 20px;
-        }
-        table {
-            margin-top: 10px;
-            margin-bottom: 20px;
-        }
-        img {
-            width: 80px; /* smaller images on mobile */
-        }
-        th, td {
-            padding: 5px; /* smaller padding on mobile */
-        }
-        .selectable {
-            font-size: 14px; /* larger font size for readability on mobile */
-        }
-    }
-    </style>
-    <script>
-    function copyToClipboard(text) {
-        navigator.clipboard.writeText(text).then(function() {
-             alert('Copied to clipboard: ' + text);
-        }).catch(function(error) {
-            console.log('Copy to clipboard failed: ' + error);
-        });
-    }
-    </script>
-    </head>
-    <body>
-    <h1>""" + custom_title + """</h1>
-    <table>
-    """
-
-    # Add rows for each image
-    for data in image_data:
-        # Split description to get text before Job ID
-        description_text = data['description']
-        job_id = data['job_id']
-
-        # Add row to HTML table
-        html_content += f"""
-        <tr>
-            <td><img src='data:image/png;base64,{data['thumbnail']}' onclick="copyToClipboard('{job_id}')"/></td>
-            <td onclick="copyToClipboard('{description_text}')" class="selectable">{description_text}</td>
-        </tr>
-        """
-
-    # Close the table and HTML tags
-    html_content += "</table></body></html>"
-
-    return html_content
-
-def add_watermark(image, watermark_text, font_path, font_size, stroke_color, overlay_position):
-    width, height = image.size
-    stroke_width=3
-    watermark_font = ImageFont.truetype(font_path, font_size)
-    # Create an image for the text to get the exact size of the text box needed
-    text_image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(text_image)
-
-    # Estimate size of watermark text
-    text_bbox = draw.textbbox((0, 0), watermark_text, font=watermark_font, stroke_width=stroke_width)
-    text_width = text_bbox[2] - text_bbox[0]
-    text_height = text_bbox[3] - text_bbox[1]
-
-    # Calculate position for watermark to avoid being cut off
-    x = max(width - text_width - stroke_width - 10, 0)  # 10 pixels from the right edge
-    if overlay_position == "Top":
-        y = 10 
-    else:
-        y = max(height - text_height - stroke_width - 10, 0)  # Place watermark at the bottom edge
-
-
-    # Draw stroke-only text
-    draw.text((x, y), watermark_text, font=watermark_font, fill=(0, 0, 0, 0), stroke_width=stroke_width, stroke_fill=stroke_color)
-
-    # Paste the text image onto the original image with transparency
-    image.paste(text_image, (0, 0), text_image)
-
-    return image
-
-def overlay_text_on_image(image, text, font_path, font_size, text_color, wrap_width_percentage, stroke_width, stroke_color, overlay_position, brightness, vertical_padding, horizontal_padding, overlay_margin, tint_color, tint_opacity, line_spacing_percentage):
-    font = ImageFont.truetype(font_path, font_size)
-
-    # Convert padding percentages to pixel values
-    vertical_padding_px = int(image.height * (vertical_padding / 100))
-    horizontal_padding_px = int(image.width * (horizontal_padding / 100))
-
-    line_height = font.getbbox('Ay')[3]
-    line_spacing = int(line_height * (line_spacing_percentage / 100.0))
-
-    # Calculate the width of the area to wrap the text in pixels
-    adjusted_wrap_percentage = min(1.6, (wrap_width_percentage/ 100) * 1.2) 
-    wrap_area_width_px = int(image.width * adjusted_wrap_percentage)    
-    average_char_width = sum(font.getbbox(char)[2] for char in 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ') / 52
-    wrap_width_chars = max(1, int(wrap_area_width_px / average_char_width))    
-    wrapped_text = textwrap.fill(text, width=wrap_width_chars)
-    wrapped_lines = wrapped_text.split('\n')    
-    max_line_width = max(font.getbbox(line)[2] for line in wrapped_lines)
-    text_block_height = sum([font.getbbox(line)[3] + font.getbbox(line)[1] for line in wrapped_lines]) + (len(wrapped_lines) - 1) * (line_spacing - line_height)
-
-    # Calculate the width and height of the blurred background
-    bg_width = max_line_width + horizontal_padding_px * 2
-    bg_height = text_block_height + vertical_padding_px * 2
-
-    # Convert margin percentage to pixel value and calculate the position
-    max_margin = (image.height - bg_height) / 2
-    overlay_margin_px = int(max_margin * (overlay_margin / 100))
-
-    # Calculate the position for the background
-    bg_x = (image.width - bg_width) // 2
-    if overlay_position == "Top":
-        bg_y = overlay_margin_px
-    else:
-        bg_y = image.height - bg_height - overlay_margin_px
-
-    # Crop and blur the background area
-    cropped_area = image.crop((bg_x, bg_y, bg_x + bg_width, bg_y + bg_height))
-    blurred_background = cropped_area.filter(ImageFilter.GaussianBlur(radius=min(horizontal_padding_px, vertical_padding_px) // 2)).convert("RGBA")
-
-    # Adjust the brightness if needed
-    if brightness != 0:
-        blurred_background = adjust_brightness(blurred_background, brightness)
-        # blurred_background = blend_with_color(blurred_background, brightness)
-    if st.session_state.overlay_settings.get('tint', False):
-        blurred_background = add_color_tint(blurred_background, tint_color, tint_opacity)
-    
-    # Create a mask for the blurred background to maintain rounded corners
-    corner_radius = max(vertical_padding_px, horizontal_padding_px) // 2
-    mask = Image.new("L", (bg_width, bg_height), 0)
-    mask_draw = ImageDraw.Draw(mask)
-    mask_draw.rounded_rectangle([(0, 0), (bg_width, bg_height)], radius=corner_radius, fill=255)
-
-    # Paste the blurred background onto the original image
-    image.paste(blurred_background, (bg_x, bg_y), mask)
-
-    # Draw the wrapped text over the blurred background
-    draw = ImageDraw.Draw(image)
-    current_y = bg_y + vertical_padding_px
-    for line in wrapped_lines:
-        text_width = font.getbbox(line)[2]
-        text_x = (image.width - text_width) // 2
-
-        # Outline text if stroke width is greater than 0
-        if stroke_width > 0:
-            draw.text((text_x, current_y), line, font=font, fill=stroke_color, stroke_width=stroke_width)
-
-        # Draw the main text
-        draw.text((text_x, current_y), line, fill=text_color, font=font)
-        current_y += line_spacing  # Increment y position for the next line
-
-    return image
-
-def extract_job_id(metadata):
-    # Attempt to find a job ID in the image metadata description
-    description = metadata.get('Description', '')
-    job_id_match = re.search(r"Job ID: ([\w-]+)", description)
-    return job_id_match.group(1) if job_id_match else "No Job ID Found"
-
-def process_images(uploaded_files):
-    image_data = []
-    dates = set()
-    total_images = 0
-
-    for uploaded_file in uploaded_files:
-        match = re.search(r"(\d{4}-\d{1,2}-\d{1,2})_\[(\d+)-(\d+)\]", uploaded_file.name)
-        if match:
-            dates.add(match.group(1))
-            start_range, end_range = int(match.group(2)), int(match.group(3))
-            total_images += (end_range - start_range + 1)
-
-        if zipfile.is_zipfile(uploaded_file):
-            with zipfile.ZipFile(uploaded_file, 'r') as z:
-                for file_name in z.namelist():
-                    if file_name.lower().endswith(('.png', '.jpg', '.jpeg')):
-                        with z.open(file_name) as image_file:
-                            img = Image.open(image_file)
-                            img_copy = img.copy()  # Create a copy of the image
-                            metadata = img.info
-                            job_id = extract_job_id(metadata)
-                            description = metadata.get('Description', 'No Description Found').split('Job ID:')[0].strip()
-                            img_copy.thumbnail((100, 100))
-                            thumb_buffer = io.BytesIO()
-                            img_copy.save(thumb_buffer, format="PNG")
-                            thumbnail = base64.b64encode(thumb_buffer.getvalue()).decode('utf-8')
-                            image_data.append({
-                                'image': img,  # Store the original image object
-                                'filename': file_name,
-                                'thumbnail': thumbnail,
-                                'description': description,
-                                'job_id': job_id,
-                                'is_zip': True
-                            })
-        else:
-            img = Image.open(uploaded_file)
-            total_images += 1
-            img_copy = img.copy()
-            metadata = img.info
-            job_id = extract_job_id(metadata)
-            description = metadata.get('Description', 'No Description Found').split('Job ID:')[0].strip()
-            img_copy.thumbnail((100, 100))
-            thumb_buffer = io.BytesIO()
-            img_copy.save(thumb_buffer, format="PNG")
-            thumbnail = base64.b64encode(thumb_buffer.getvalue()).decode('utf-8')
-            image_data.append({
-                'image': img,
-                'filename': uploaded_file.name,
-                'thumbnail': thumbnail,
-                'description': description,
-                'job_id': job_id,
-                'is_zip': False
-            })
-
-    if dates:
-        dates_str = '_'.join(sorted(dates))
-        html_file_name = f"{dates_str}-[{total_images}].html"
-    else:
-        html_file_name = "image_metadata.html"
-
-    return image_data, html_file_name, total_images
+def load_image(source):
+    # Full-resolution pixels are only decoded once an image is actually selected
+    return Image.open(io.BytesIO(source.read()))
 
 st.title("PromptMark Studio")
 
@@ -496,6 +283,8 @@ st.title("PromptMark Studio")
 st.sidebar.title("Overlay Settings")
 user_name = st.sidebar.text_input("Corner text:", on_change= update_watermark,
                                   help= "Enter text to display in the corner of the image." )
+watermark_size = st.sidebar.slider("Corner text size", 8, 72, 24, key="watermark_size", on_change=lambda: update_settings('watermark_size', st.session_state.watermark_size),
+                                   help="Font size of the corner text at full resolution.")
 
 # Font settings inside an expander
 with st.sidebar.expander("Text Styling options", True):
@@ -585,51 +374,186 @@ with layout["file_upload"]:
     uploaded_files = st.file_uploader("Upload ZIP files containing images", type=['png', 'jpeg', 'zip'], accept_multiple_files=True)
 
 all_image_data=[]
+# The images the search leaves; the HTML export is generated from these
+gallery_image_data=[]
 
 with layout["image_display"]:    
     if st.session_state.update_needed:
         update_selected_image()                
-    # Always display the processed image if it exists
-    if 'processed_image' in st.session_state and st.session_state.processed_image is not None:
-        st.image(st.session_state.processed_image, caption="Current", use_column_width=True)
+    # Only the frame reruns while a render is in progress, which keeps the rest of the page responsive
+    polling = st.session_state.render_worker.busy()
+    st.fragment(show_processed_image, run_every=RENDER_POLL_SECONDS if polling else None)(polling)
 
 
 with layout["image_download"]:
-    buffer, filename = prepare_download()
-    if buffer and filename:
+    if st.session_state.selected_image_info['key'] is not None:
+        with st.expander("Download options", False):
+            output_format = st.selectbox("Format", list(OUTPUT_FORMATS), key="download_format", format_func=str.upper)
+            if output_format == 'png':
+                st.slider("PNG compression level", 0, 9, 6, key="download_compress_level",
+                          help="Higher levels make smaller files but take longer to encode.")
+            else:
+                st.slider("Quality", 1, 100, 90, key="download_quality")
+            st.checkbox("Optimize", key="download_optimize",
+                        help="Spend extra encoding time for a smaller file.")
+            st.multiselect("Export sizes", list(EXPORT_PRESETS), key="download_presets",
+                           format_func=lambda name: f"{name} ({EXPORT_PRESETS[name][0]}x{EXPORT_PRESETS[name][1] or 'auto'})",
+                           help="Download a ZIP with the image cropped and resized to each of these sizes instead of the full-resolution image.")
+    encoded, filename, mime = prepare_download()
+    if encoded and filename:
         st.download_button(
-            label="Download Image",
-            data=buffer,
+            label="Download sizes (ZIP)" if filename.endswith('.zip') else "Download Image",
+            data=encoded,
             file_name=filename,
-            mime="image/png"
+            mime=mime
         )
+    elif st.session_state.selected_image_info['key'] is not None:
+        st.button("Render full resolution", on_click=request_download,
+                  help="The preview is rendered at reduced size; render the full-resolution image to download it.")
 
 with layout["image_selection"]:
     if uploaded_files:
-        all_image_data, html_file_name, total_images = process_images(uploaded_files)
+        skip_duplicates = st.checkbox("Skip duplicate images", True, key="skip_duplicates",
+                                      help="List images that appear in several uploads only once.")
+        with trace.trace('ingest', files=len(uploaded_files)):
+            all_image_data, html_file_name, total_images = process_images(uploaded_files, st.session_state.ingest_cache, store=get_store(),
+                                                                          skip_duplicates=skip_duplicates, near_duplicates=st.session_state.near_duplicates)
+        # Images from earlier uploads stay indexed; start afresh once they outnumber the current ones
+        if len(st.session_state.near_duplicates) > 2 * len(all_image_data):
+            st.session_state.near_duplicates = NearDuplicateIndex()
         
-        # Display each uploaded image with an option to select for overlay
-        for idx, data in enumerate(all_image_data):
+        st.session_state.search_index.sync(all_image_data)
+        search_query = st.text_input("Search", key="search_query", on_change=reset_selection_page,
+                                     help="Words in descriptions, job IDs or filenames, matched by prefix. "
+                                          "job:ID and date:YYYY-MM-DD or date:FROM..TO narrow the search further.")
+        collapse_similar = st.checkbox("Collapse near-duplicates", key="collapse_similar", on_change=reset_selection_page,
+                                       help="Show one image from each group of near-identical images, such as re-encodes or resized copies.")
+        matched = st.session_state.search_index.filter(all_image_data, search_query)
+        similar_counts = {}
+        for idx in matched:
+            similar_counts[all_image_data[idx]['group']] = similar_counts.get(all_image_data[idx]['group'], 0) + 1
+        if collapse_similar:
+            # Keep the first match of each group; the group's own first image may not be loaded any more
+            first_matches = {}
+            for idx in matched:
+                first_matches.setdefault(all_image_data[idx]['group'], idx)
+            matched = sorted(first_matches.values())
+        gallery_image_data = [all_image_data[idx] for idx in matched] if search_query.strip() or collapse_similar else all_image_data
+
+        page_count = max(1, -(-len(matched) // SELECTION_PAGE_SIZE))
+        # Fewer images than before can leave the remembered page past the end
+        if st.session_state.get('selection_page', 1) > page_count:
+            st.session_state.selection_page = page_count
+        if page_count > 1:
+            page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1, key="selection_page")
+        else:
+            page = 1
+        start = (page - 1) * SELECTION_PAGE_SIZE
+        end = min(start + SELECTION_PAGE_SIZE, len(matched))
+        if not matched:
+            st.caption("No images match the search.")
+        elif len(matched) < len(all_image_data):
+            st.caption(f"Showing matches {start + 1}-{end} of {len(matched)} ({len(all_image_data)} images loaded)")
+        else:
+            st.caption(f"Showing images {start + 1}-{end} of {len(all_image_data)}")
+
+        # Widget keys come from image content, numbered when the same image appears more than once,
+        # so they stay the same whichever page is shown and whatever the search
+        occurrences = {}
+        widget_keys = []
+        for data in all_image_data[:matched[end - 1] + 1 if matched else 0]:
+            occurrences[data['key']] = occurrences.get(data['key'], -1) + 1
+            widget_keys.append(f"{data['key']}_{occurrences[data['key']]}")
+
+        # Display each image on the current page with an option to select for overlay
+        selected = st.session_state.selected_image_info
+        for idx in matched[start:end]:
+            data = all_image_data[idx]
             cols = st.columns([1, 3, 1])
-            cols[0].image(f"data:image/png;base64,{data['thumbnail']}", use_column_width=True, width=150)        
+            cols[0].image(f"data:{data['thumbnail_mime']};base64,{data['thumbnail']}", use_column_width=True, width=150)        
             cols[1].write( textwrap.fill(data['description'], width=50))
+            if similar_counts[data['group']] > 1:
+                cols[1].caption(f"{similar_counts[data['group']] - 1} near-duplicate(s) {'hidden' if collapse_similar else 'in this list'}")
 
             # Button to select the image for overlay
+            is_selected = data['key'] == selected['key'] and data['filename'] == selected['filename']
             select_button = partial(update_text, data)
-            if cols[2].button(f"Select Img {idx}", key=f"btn_select_{idx}",  on_click=select_button):                                                
+            if cols[2].button("Selected" if is_selected else f"Select Img {idx}", key=f"btn_select_{widget_keys[idx]}", on_click=select_button,
+                              type="primary" if is_selected else "secondary"):
                 select_and_display_image(data)
                 
 
 with layout["html_generation"]:    
-    if all_image_data:
+    if gallery_image_data:
         custom_title = st.text_input("Enter a custom title for the HTML file:", "My Image Collection")
+        split_pages = st.checkbox("Split into pages", help="Write a ZIP of linked pages with lazy-loaded thumbnails, for large collections.")
+        if split_pages:
+            rows_per_page = st.number_input("Rows per page", min_value=10, max_value=5000, value=200, step=10)
+        sprite_atlas = st.checkbox("Pack thumbnails into sprite atlases", help="Combine thumbnails into a few larger images addressed by CSS offsets.")
         if custom_title and st.button('Generate HTML'):
-            html_content = create_html_table(all_image_data, custom_title)
+            # The gallery is streamed into a spooled file rather than built up as one string
+            gallery_file = tempfile.SpooledTemporaryFile(max_size=GALLERY_SPOOL_BYTES)
+            if split_pages:
+                write_gallery_pages(gallery_image_data, custom_title, gallery_file, rows_per_page, sprite_atlas)
+                gallery_name, gallery_mime = f"{html_file_name.rsplit('.', 1)[0]}.zip", "application/zip"
+            else:
+                write_html_table(gallery_image_data, custom_title, gallery_file, sprite_atlas)
+                gallery_name, gallery_mime = html_file_name, "text/html"
+            gallery_file.seek(0)
             st.download_button(
                 label="Download HTML",
-                data=html_content,
-                file_name=html_file_name,
-                mime="text/html"
+                data=gallery_file.read(),
+                file_name=gallery_name,
+                mime=gallery_mime
             )
         elif not custom_title:
-            st.warning("Please enter a custom title to enable HTML download.")
\ No newline at end of file
+            st.warning("Please enter a custom title to enable HTML download.")
+
+with layout["batch_export"]:
+    if all_image_data and st.button('Export all with overlay', help="Apply the current overlay settings to every uploaded image and download them as a ZIP."):
+        progress_bar = st.progress(0.0, text="Rendering images...")
+        # Rendered images go straight into a ZIP on disk rather than being held in memory
+        export_file = tempfile.TemporaryFile()
+        export_batch(all_image_data, dict(st.session_state.overlay_settings), user_name, export_file,
+                     progress=lambda done, total: progress_bar.progress(done / total, text=f"Rendered {done} of {total} images"))
+        export_file.seek(0)
+        st.download_button(
+            label="Download ZIP",
+            data=export_file.read(),
+            file_name=f"overlay_{html_file_name.rsplit('.', 1)[0]}.zip",
+            mime="application/zip"
+        )
+
+# Rendered last so it includes the timings of this rerun
+with st.sidebar.expander("Debug", False):
+    st.checkbox("Record stage timings", value=trace.enabled(), key="trace_enabled", on_change=lambda: trace.set_enabled(st.session_state.trace_enabled),
+                help="Time each render stage. Timings are shared by every session of this server.")
+    recent_traces, counters = trace.snapshot()
+    if recent_traces:
+        rows = []
+        for record in reversed(recent_traces):
+            row = {'operation': record['trace'], 'total ms': record['total_ms']}
+            for name, elapsed_ms in record['spans']:
+                row[name] = round(row.get(name, 0) + elapsed_ms, 1)
+            rows.append(row)
+        st.write("Recent operations (stages run only when their inputs changed)")
+        st.dataframe(rows, hide_index=True)
+        st.write("Totals")
+        st.dataframe([{'stage': name, 'count': counter['count'], 'total ms': round(counter['total_ms'], 1),
+                       'mean ms': round(counter['total_ms'] / counter['count'], 2), 'max ms': round(counter['max_ms'], 1)}
+                      for name, counter in sorted(counters.items())], hide_index=True)
+        st.button("Clear timings", on_click=trace.reset)
+    elif trace.enabled():
+        st.caption("No operations recorded yet.")
+    # Memory held for decoded frames is bounded by the frame cache budgets; this shows how much is in use
+    frame_cache = get_frame_cache()
+    frame_usage = frame_cache.usage(st.session_state.session_id)
+    megabytes = lambda size: round(size / (1024 * 1024), 1)
+    st.write("Memory")
+    st.dataframe([
+        {'cache': 'Frames, this session', 'MB': megabytes(frame_usage['session_bytes']), 'budget MB': megabytes(frame_cache.session_budget_bytes), 'items': frame_usage['session_frames']},
+        {'cache': 'Frames, all sessions', 'MB': megabytes(frame_usage['bytes']), 'budget MB': megabytes(frame_cache.global_budget_bytes), 'items': frame_usage['frames']},
+        {'cache': 'Ingest, this session', 'MB': megabytes(st.session_state.ingest_cache.size), 'budget MB': megabytes(INGEST_CACHE_BUDGET_BYTES), 'items': len(st.session_state.ingest_cache)},
+    ], hide_index=True)
+    st.caption(f"Frame cache: {frame_usage['hits']} hits, {frame_usage['misses']} misses, {frame_usage['evictions']} evictions, "
+               f"{frame_usage['sessions']} session(s)")
@@ -0,0 +1,96 @@
+import sys
+import time
+import argparse
+import numpy as np
+from benchmarks.common import synthetic_photo
+from promptmark.render import blur_backdrop, blur_factor
+
+IMAGE_SIZES = {'2k': (2048, 2048), '4k': (3840, 2160), '8k': (7680, 4320)}
+PADDINGS = (1.0, 3.0, 5.0)
+
+# The approximate blur fails the check if it is further than this from the exact blur, in 8-bit levels
+MAX_MEAN_DIFFERENCE = 1.0
+MAX_P999_DIFFERENCE = 8
+
+
+def backdrop_box(size, padding):
+    # Same geometry as a bottom overlay covering most of the width, sized from the padding percentage
+    width, height = size
+    padding_px = int(height * padding / 100)
+    box_height = min(height, height // 4 + padding_px * 2)
+    return (width // 20, height - box_height, width - width // 20, height), padding_px // 2
+
+
+def timed(run, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = run()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def compare(image, box, radius):
+    # Difference statistics between the exact and approximate blur, or None where the approximate blur would
+    # not reduce at all (small radii), since it is then the exact blur itself and there is nothing to compare
+    exact = blur_backdrop(image, box, radius, 'exact')
+    if blur_factor(radius, exact.size, 'approximate') == 1:
+        return None
+    approximate = blur_backdrop(image, box, radius, 'approximate')
+    difference = np.abs(np.asarray(exact, dtype=np.int16) - np.asarray(approximate, dtype=np.int16))
+    return difference.mean(), np.percentile(difference, 99.9), difference.max()
+
+
+def check(sizes=IMAGE_SIZES):
+    # Asserts the approximate blur stays within the thresholds for every size and padding that reduces
+    failures = []
+    for size_name, size in sizes.items():
+        image = synthetic_photo(size, 3)
+        for padding in PADDINGS:
+            box, radius = backdrop_box(size, padding)
+            stats = compare(image, box, radius)
+            if stats is not None and (stats[0] > MAX_MEAN_DIFFERENCE or stats[1] > MAX_P999_DIFFERENCE):
+                failures.append(f"{size_name} padding {padding}% (mean {stats[0]:.3f}, p99.9 {stats[1]:.1f})")
+    assert not failures, f"Approximate blur differs beyond the threshold for: {', '.join(failures)}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the exact and approximate backdrop blur for time and visual difference. "
+                                                 "Run from the repository root as: python -m benchmarks.backdrop_blur")
+    parser.add_argument("--repeat", type=int, default=3, help="Blurs per measurement (default: %(default)s).")
+    parser.add_argument("--check", action="store_true",
+                        help="Only check the approximate blur against the thresholds, without timing; fails with an AssertionError.")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        check()
+        print("Approximate blur is within the thresholds")
+        return 0
+
+    failures = []
+    print(f"{'size':5s} {'padding':>8s} {'radius':>7s} {'factor':>7s} {'exact ms':>9s} {'auto ms':>9s} {'mean diff':>10s} {'p99.9 diff':>11s} {'max diff':>9s}")
+    for size_name, size in IMAGE_SIZES.items():
+        image = synthetic_photo(size, 3)
+        for padding in PADDINGS:
+            box, radius = backdrop_box(size, padding)
+            exact, exact_time = timed(lambda: blur_backdrop(image, box, radius, 'exact'), args.repeat)
+            _, auto_time = timed(lambda: blur_backdrop(image, box, radius, 'auto'), args.repeat)
+            factor = blur_factor(radius, exact.size, 'auto')
+            # The difference is always that of the approximate blur, including where auto would stay exact;
+            # rows where even the approximate blur doesn't reduce have no difference to report
+            stats = compare(image, box, radius)
+            if stats is None:
+                differences = f"{'-':>10s} {'-':>11s} {'-':>9s}"
+            else:
+                mean, p999, worst = stats
+                if mean > MAX_MEAN_DIFFERENCE or p999 > MAX_P999_DIFFERENCE:
+                    failures.append(f"{size_name} padding {padding}%")
+                differences = f"{mean:10.3f} {p999:11.1f} {worst:9d}"
+            print(f"{size_name:5s} {padding:7.1f}% {radius:7d} {factor:7d} {exact_time * 1000:9.1f} {auto_time * 1000:9.1f} {differences}", flush=True)
+
+    if failures:
+        print(f"Approximate blur differs beyond the threshold for: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import io
+import resource
+from PIL import Image, ImageDraw, ImageFilter, PngImagePlugin
+
+
+def synthetic_photo(size, seed):
+    # Smooth gradients, soft shapes and sensor-like noise, close enough to a generated image for size comparisons
+    width, height = size
+    gradient = Image.linear_gradient('L').resize(size)
+    image = Image.merge('RGB', (gradient, gradient.rotate(90 + seed * 37 % 180).resize(size), Image.radial_gradient('L').resize(size)))
+    draw = ImageDraw.Draw(image)
+    for i in range(12):
+        x, y = (seed * 97 + i * 131) % width, (seed * 61 + i * 89) % height
+        radius = width // (4 + i % 5)
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=((i * 53 + seed) % 256, (i * 29) % 256, (i * 71) % 256))
+    image = image.filter(ImageFilter.GaussianBlur(width / 100))
+    noise = Image.effect_noise(size, 24).convert('RGB')
+    return Image.blend(image, noise, 0.08)
+
+
+def synthetic_png(size, description, seed=0):
+    # A PNG carrying its prompt in a Description text chunk, the way generator exports do
+    info = PngImagePlugin.PngInfo()
+    info.add_text('Description', description)
+    buffer = io.BytesIO()
+    synthetic_photo(size, seed).save(buffer, format='PNG', pnginfo=info)
+    return buffer.getvalue()
+
+
+def proc_status_kib(field):
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_kib():
+    # VmHWM starts over with each new process image; ru_maxrss would carry over the parent's peak on Linux
+    peak = proc_status_kib('VmHWM')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if peak is None else peak
+
+
+def reset_peak_rss():
+    # Linux resets VmHWM to the current RSS when 5 is written to clear_refs; returns False where unsupported
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def current_rss_kib():
+    return proc_status_kib('VmRSS') or 0
@@ -0,0 +1,188 @@
+import io
+import base64
+import sys
+import json
+import time
+import zipfile
+import argparse
+import platform
+import PIL
+from benchmarks.common import current_rss_kib, peak_rss_kib, reset_peak_rss, synthetic_photo, synthetic_png
+from promptmark.export import EXPORT_PRESETS, render_presets
+from promptmark.gallery import iter_html_table
+from promptmark.ingest import process_images
+from promptmark.render import add_watermark, overlay_text_on_image, process_image
+from promptmark.settings import FONT_FILES, make_settings
+
+SHORT_DESCRIPTION = "A lighthouse at dusk, volumetric light --ar 16:9"
+LONG_DESCRIPTION = " ".join([
+    "An intricately detailed matte painting of a sprawling floating city above a sea of clouds at golden hour,",
+    "with brass airships docking at terraced gardens, waterfalls spilling off the edges into mist,",
+    "crowds of tiny figures on suspension bridges, banners fluttering in the wind, soft volumetric light,",
+    "cinematic composition, ultra wide angle, hyperrealistic textures, octane render, trending on artstation",
+] * 4)
+DESCRIPTIONS = {'short': SHORT_DESCRIPTION, 'long': LONG_DESCRIPTION}
+
+IMAGE_SIZES = {'512': (512, 512), '1k': (1024, 1024), '2k': (2048, 2048), '4k': (3840, 2160), '8k': (7680, 4320)}
+# ZIP members are small so archives of thousands of images stay quick to build
+ZIP_MEMBER_SIZE = (256, 256)
+
+PROFILES = {
+    'quick': {'sizes': ['512', '2k'], 'fonts': ['Lato-Regular.ttf'], 'zips': [10, 100], 'galleries': [100, 1000]},
+    'full': {'sizes': list(IMAGE_SIZES), 'fonts': sorted(FONT_FILES), 'zips': [10, 100, 1000, 5000], 'galleries': [100, 1000, 5000]},
+}
+
+
+class NamedBytes(io.BytesIO):
+    # Stands in for a Streamlit upload: a binary file object with a name
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile, so reported values are always real samples
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def measure(run, repeat, units=1, warmup=1):
+    for _ in range(warmup):
+        run()
+    rss_before = current_rss_kib()
+    tracked = reset_peak_rss()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    mean = sum(timings) / len(timings)
+    return {
+        'p50_ms': percentile(timings, 0.5) * 1000,
+        'p90_ms': percentile(timings, 0.9) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'throughput': units / mean,
+        # Growth of the peak over the RSS at the start of the case; unavailable where VmHWM can't be reset
+        'peak_mib': max(0, peak_rss_kib() - rss_before) / 1024 if tracked else None,
+        'repeat': repeat,
+    }
+
+
+def render_cases(profile, repeat):
+    for size_name in profile['sizes']:
+        size = IMAGE_SIZES[size_name]
+        image = synthetic_photo(size, 1)
+        font_size = max(24, size[0] // 40)
+        for font_path in profile['fonts']:
+            font_name = font_path.split('-')[0]
+            for description_name, description in DESCRIPTIONS.items():
+                for stroke in (False, True):
+                    for tint in (False, True):
+                        settings = make_settings(font_path=font_path, font_size=font_size, stroke_width=4 if stroke else 0,
+                                                 tint=tint, brightness=-40 if tint else 0)
+                        name = f"render/{size_name}/{font_name}/{description_name}/{'stroke' if stroke else 'plain'}/{'tint' if tint else 'clear'}"
+                        yield name, lambda image=image, description=description, settings=settings: process_image(image, description, settings, 'benchmark'), 1, repeat
+
+        # Individual stages and the interactive path, on the default font and a long description
+        settings = make_settings(font_size=font_size)
+        overlay_settings = {key: settings[key] for key in (
+            'font_path', 'font_size', 'text_color', 'wrap_width_percentage', 'stroke_width', 'stroke_color', 'overlay_position',
+            'brightness', 'vertical_padding', 'horizontal_padding', 'overlay_margin', 'tint_color', 'tint_opacity', 'line_spacing_percentage')}
+        # Cases run after the whole matrix is built, so every lambda binds its inputs as defaults
+        yield f"overlay/{size_name}", lambda image=image, overlay_settings=overlay_settings: overlay_text_on_image(image, LONG_DESCRIPTION, **overlay_settings), 1, repeat
+        yield f"watermark/{size_name}", lambda image=image: add_watermark(image.copy(), 'benchmark', 'Lato-Regular.ttf', 24, '#000000', 'Bottom'), 1, repeat
+
+        layers = {}
+        colors = iter(['#000000', '#FF0000'] * (repeat + 2))
+        def rerender(image=image, settings=settings, layers=layers, colors=colors):
+            return process_image(image, LONG_DESCRIPTION, dict(settings, text_color=next(colors)), 'benchmark', layers)
+        yield f"rerender-text-color/{size_name}", rerender, 1, repeat
+        # Every export preset of one image; units are the sizes produced
+        yield f"presets/{size_name}", lambda image=image, settings=settings: list(render_presets(image, LONG_DESCRIPTION, settings, 'benchmark')), len(EXPORT_PRESETS), repeat
+
+
+def ingest_cases(profile, repeat, workers):
+    for count in profile['zips']:
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            for i in range(count):
+                archive.writestr(f"image_{i:05d}.png", synthetic_png(ZIP_MEMBER_SIZE, f"{SHORT_DESCRIPTION} {i} Job ID: bench-{i}", i))
+        data = buffer.getvalue()
+        name = f"2024-01-01_[1-{count}].zip"
+        yield f"ingest/zip-{count}", lambda data=data, name=name: process_images([NamedBytes(name, data)], workers=workers), count, max(1, repeat // 2)
+
+
+def gallery_cases(profile, repeat):
+    thumbnail = synthetic_photo(ZIP_MEMBER_SIZE, 2)
+    thumbnail.thumbnail((100, 100))
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format='PNG')
+    encoded = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    for count in profile['galleries']:
+        image_data = [{'key': str(i), 'thumbnail': encoded, 'thumbnail_mime': 'image/png', 'job_id': f"bench-{i}",
+                       'description': SHORT_DESCRIPTION if i % 2 else LONG_DESCRIPTION} for i in range(count)]
+        def write(image_data=image_data):
+            # Stream into a sink, as the app does with its spooled file
+            return sum(len(chunk) for chunk in iter_html_table(image_data, "Benchmark"))
+        yield f"gallery/{count}", write, count, repeat
+
+
+def compare(results, baseline, threshold):
+    # Prints p50 changes against a saved baseline and returns the cases that got slower than threshold
+    regressions = []
+    print(f"\n{'case':58s} {'baseline p50':>13s} {'p50':>10s} {'change':>8s}")
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:58s} {'-':>13s} {result['p50_ms']:10.2f} {'new':>8s}")
+            continue
+        change = result['p50_ms'] / old['p50_ms'] - 1 if old['p50_ms'] else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:58s} {old['p50_ms']:13.2f} {result['p50_ms']:10.2f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the PromptMark render, ingest and gallery hot paths on synthetic inputs. "
+                                                 "Run from the repository root as: python -m benchmarks.suite")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick", help="Input matrix to run (default: %(default)s).")
+    parser.add_argument("--filter", default="", help="Only run cases whose name contains this text.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per case (default: %(default)s).")
+    parser.add_argument("--workers", type=int, default=1, help="Ingest worker processes (default: %(default)s).")
+    parser.add_argument("--save", metavar="PATH", help="Write the results as a JSON baseline.")
+    parser.add_argument("--compare", metavar="PATH", help="Compare against a saved baseline and exit non-zero on regressions.")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown counted as a regression (default: %(default)s).")
+    args = parser.parse_args(argv)
+
+    profile = PROFILES[args.profile]
+    cases = [*render_cases(profile, args.repeat), *ingest_cases(profile, args.repeat, args.workers), *gallery_cases(profile, args.repeat)]
+
+    results = {}
+    print(f"{'case':58s} {'p50 ms':>9s} {'p90 ms':>9s} {'p99 ms':>9s} {'per s':>9s} {'peak MiB':>9s}")
+    for name, run, units, repeat in cases:
+        if args.filter not in name:
+            continue
+        result = measure(run, repeat, units)
+        results[name] = result
+        peak = '-' if result['peak_mib'] is None else f"{result['peak_mib']:.1f}"
+        print(f"{name:58s} {result['p50_ms']:9.2f} {result['p90_ms']:9.2f} {result['p99_ms']:9.2f} {result['throughput']:9.1f} {peak:>9s}", flush=True)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'meta': {'profile': args.profile, 'python': platform.python_version(), 'pillow': PIL.__version__,
+                                'machine': platform.machine()}, 'results': results}, baseline_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
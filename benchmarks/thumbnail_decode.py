@@ -0,0 +1,60 @@
+import io
+import time
+import argparse
+from multiprocessing import get_context
+from PIL import Image
+from benchmarks.common import peak_rss_kib, synthetic_photo
+from promptmark.thumbnails import THUMBNAIL_SIZE, make_thumbnail
+
+
+def full_decode_thumbnail(data):
+    # The original ingest path: decode everything via copy(), then shrink
+    img = Image.open(io.BytesIO(data))
+    img_copy = img.copy()
+    img_copy.thumbnail(THUMBNAIL_SIZE)
+    return img_copy
+
+
+def reduced_decode_thumbnail(data):
+    return make_thumbnail(Image.open(io.BytesIO(data)))
+
+
+PATHS = {'full decode': full_decode_thumbnail, 'reduced decode': reduced_decode_thumbnail}
+
+
+def measure(path, data, repeat):
+    # Runs in a fresh process so the peak reflects this path alone
+    baseline = peak_rss_kib()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        PATHS[path](data)
+    elapsed = (time.perf_counter() - start) / repeat
+    peak = peak_rss_kib() - baseline
+    return elapsed, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare thumbnail time and peak memory for full versus reduced decoding.")
+    parser.add_argument("--size", type=int, default=4096, help="Source image width and height (default: %(default)s).")
+    parser.add_argument("--repeat", type=int, default=5, help="Thumbnails per measurement (default: %(default)s).")
+    args = parser.parse_args(argv)
+
+    image = synthetic_photo((args.size, args.size), 1)
+    sources = {}
+    for image_format in ('JPEG', 'PNG'):
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format)
+        sources[image_format] = buffer.getvalue()
+
+    # Every measurement gets its own process to keep peaks independent
+    context = get_context('spawn')
+    print(f"{'format':8s} {'path':16s} {'ms':>9s} {'peak RSS MiB':>13s}")
+    for image_format, data in sources.items():
+        for path in PATHS:
+            with context.Pool(1) as pool:
+                elapsed, peak = pool.apply(measure, (path, data, args.repeat))
+            print(f"{image_format:8s} {path:16s} {elapsed * 1000:9.1f} {peak / 1024:13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import base64
+import time
+import argparse
+from benchmarks.common import synthetic_photo
+from promptmark.thumbnails import THUMBNAIL_ENCODERS, THUMBNAIL_SIZE, build_sprite_atlas, encode_thumbnail
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare thumbnail encoders by bytes per thumbnail and encode time.")
+    parser.add_argument("--count", type=int, default=50, help="Number of synthetic images (default: %(default)s).")
+    parser.add_argument("--size", type=int, default=1024, help="Source image width and height (default: %(default)s).")
+    parser.add_argument("--quality", type=int, default=80, help="JPEG/WebP quality (default: %(default)s).")
+    args = parser.parse_args(argv)
+
+    thumbnails = []
+    for seed in range(args.count):
+        image = synthetic_photo((args.size, args.size), seed)
+        image.thumbnail(THUMBNAIL_SIZE)
+        thumbnails.append(image)
+
+    # The atlas packs from PNG-encoded thumbnails, as ingest stores them by default
+    image_data = [{'key': str(i), 'thumbnail': base64.b64encode(encode_thumbnail(image, 'png')[0]).decode('utf-8')}
+                  for i, image in enumerate(thumbnails)]
+
+    print(f"{'encoder':10s} {'bytes/thumb':>12s} {'encode ms':>10s} {'atlas bytes/thumb':>18s}")
+    for encoder in THUMBNAIL_ENCODERS:
+        start = time.perf_counter()
+        encoded = [encode_thumbnail(image, encoder, args.quality)[0] for image in thumbnails]
+        elapsed = time.perf_counter() - start
+        atlas = build_sprite_atlas(image_data, encoder, args.quality)
+        atlas_bytes = sum(len(a['data']) for a in atlas['atlases'])
+        print(f"{encoder:10s} {sum(map(len, encoded)) / len(encoded):12.0f} {elapsed * 1000 / len(encoded):10.2f} {atlas_bytes / len(thumbnails):18.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+from promptmark.export import export_batch
+from promptmark.ingest import IngestCache, process_images
+from promptmark.render import process_image
+from promptmark.settings import DEFAULT_OVERLAY_SETTINGS, FONT_FILES, make_settings
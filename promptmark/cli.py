@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import argparse
+from promptmark.export import EXPORT_PRESETS, export_batch
+from promptmark.ingest import INGEST_CHUNK_SIZE, INGEST_WORKERS, process_images
+from promptmark.settings import DEFAULT_OVERLAY_SETTINGS, make_settings
+from promptmark.store import STORE_PATH, IngestStore
+
+INPUT_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.zip')
+
+
+def collect_inputs(paths):
+    # Directories are walked in sorted order so repeated runs produce the same output
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.lower().endswith(INPUT_EXTENSIONS))
+        else:
+            files.append(path)
+    return files
+
+
+def parse_setting(text):
+    key, separator, value = text.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {text!r}")
+    return key.strip(), value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="promptmark", description="Apply the PromptMark text overlay to images, directories of images or ZIP exports.",
+                                     epilog="The package is not installed, so 'python -m promptmark' only finds it from the repository root. "
+                                            "From any other directory, as in cron jobs or workers, point PYTHONPATH at the repository: "
+                                            "PYTHONPATH=/path/to/promptmark python -m promptmark photos/ -o out.zip. "
+                                            "Input and output paths are relative to the current directory.")
+    parser.add_argument("inputs", nargs="+", help="Image files, ZIP files or directories containing them.")
+    parser.add_argument("-o", "--output", required=True, help="Path of the ZIP file to write the overlaid images to.")
+    parser.add_argument("--set", dest="settings", action="append", type=parse_setting, default=[], metavar="KEY=VALUE",
+                        help=f"Override an overlay setting. Known settings: {', '.join(DEFAULT_OVERLAY_SETTINGS)}.")
+    parser.add_argument("--watermark", default="", help="Corner text to draw on every image.")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="Worker processes for ingest and rendering (default: %(default)s).")
+    parser.add_argument("--chunksize", type=int, default=INGEST_CHUNK_SIZE, help="Images sent to an ingest worker at a time (default: %(default)s).")
+    parser.add_argument("--store", default=STORE_PATH, help="Persistent ingest store shared with the app (default: %(default)s).")
+    parser.add_argument("--no-store", action="store_true", help="Don't read or write the persistent ingest store.")
+    parser.add_argument("--preset", dest="presets", action="append", choices=[*EXPORT_PRESETS, 'all'], default=[],
+                        help="Write the image at an export preset size instead of at full size; repeat for several sizes, or 'all'.")
+    parser.add_argument("--skip-duplicates", action="store_true", help="Export identical images found in several inputs only once.")
+    args = parser.parse_args(argv)
+
+    try:
+        settings = make_settings(dict(args.settings))
+    except (KeyError, ValueError) as error:
+        parser.error(error.args[0])
+
+    presets = None
+    if args.presets:
+        presets = {name: EXPORT_PRESETS[name] for name in (EXPORT_PRESETS if 'all' in args.presets else args.presets)}
+
+    paths = collect_inputs(args.inputs)
+    if not paths:
+        parser.error("no images or ZIP files found in the given inputs")
+    # The records read their images from these files, so they stay open until the export is written
+    files = [open(path, 'rb') for path in paths]
+    try:
+        start = time.perf_counter()
+        store = None if args.no_store or not args.store else IngestStore(args.store)
+        image_data, _, _ = process_images(files, workers=args.workers, chunksize=args.chunksize, store=store, skip_duplicates=args.skip_duplicates)
+        ingest_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        export_batch(image_data, settings, args.watermark, args.output, workers=args.workers, presets=presets)
+        render_seconds = time.perf_counter() - start
+    finally:
+        for file in files:
+            file.close()
+
+    # Timings go to stderr so they can be collected when benchmarking different worker counts
+    count = len(image_data)
+    print(f"{count} images: ingest {ingest_seconds:.2f}s, render {render_seconds:.2f}s "
+          f"({count / render_seconds if render_seconds else 0:.1f} images/s) -> {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
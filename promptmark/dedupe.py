@@ -0,0 +1,59 @@
+import io
+import os
+import base64
+from PIL import Image
+
+# Images whose difference hashes are at most this many bits apart are grouped as near-duplicates
+NEAR_DUPLICATE_DISTANCE = int(os.environ.get('PROMPTMARK_NEAR_DUPLICATE_DISTANCE', 3))
+
+
+def difference_hash(img):
+    # 64-bit dHash of a 9x8 grayscale reduction: each bit says whether a pixel is brighter than its right
+    # neighbour. Re-encodes and small resizes of the same image land within a few bits of each other.
+    pixels = img.convert('L').resize((9, 8), Image.BILINEAR).tobytes()
+    value = 0
+    for row in range(0, 72, 9):
+        for col in range(row, row + 8):
+            value = (value << 1) | (pixels[col] > pixels[col + 1])
+    return value
+
+
+def thumbnail_hash(thumbnail):
+    # For entries ingested before hashes were recorded; the base64 thumbnail is small enough to decode
+    return difference_hash(Image.open(io.BytesIO(base64.b64decode(thumbnail))))
+
+
+class NearDuplicateIndex:
+    # Groups near-duplicate hashes in O(1) per image with a banded multi-index. The 64 bits are split into
+    # distance + 1 bands; two hashes at most distance bits apart must agree exactly on at least one band,
+    # so only images sharing a band value are ever compared. Each image joins the group of the first
+    # earlier image within distance of it, and groups are named after their first image's key.
+
+    def __init__(self, distance=NEAR_DUPLICATE_DISTANCE):
+        self.distance = distance
+        bands = distance + 1
+        bounds = [64 * band // bands for band in range(bands + 1)]
+        self.bands = [(low, (1 << (high - low)) - 1) for low, high in zip(bounds, bounds[1:])]
+        self.tables = [{} for _ in self.bands]
+        self.groups = {}
+
+    def __len__(self):
+        return len(self.groups)
+
+    def add(self, key, value):
+        # Returns the group key for key
+        group = self.groups.get(key)
+        if group is not None:
+            return group
+        band_values = [(value >> shift) & mask for shift, mask in self.bands]
+        for table, band_value in zip(self.tables, band_values):
+            for other_key, other_value in table.get(band_value, ()):
+                if bin(value ^ other_value).count('1') <= self.distance:
+                    group = self.groups[other_key]
+                    break
+            if group is not None:
+                break
+        for table, band_value in zip(self.tables, band_values):
+            table.setdefault(band_value, []).append((key, value))
+        self.groups[key] = key if group is None else group
+        return self.groups[key]
@@ -0,0 +1,195 @@
+import io
+import os
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from PIL import Image
+from promptmark.ingest import INGEST_WORKERS, get_executor
+from promptmark.render import process_image
+from promptmark.trace import span
+
+# Renders allowed in flight per worker; this bounds peak memory to a few decoded images per worker
+BATCH_INFLIGHT_PER_WORKER = 2
+
+# Output format name -> (Pillow format, MIME type, file extension)
+OUTPUT_FORMATS = {
+    'png': ('PNG', 'image/png', 'png'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+}
+
+# Export preset name -> (width, height). The source is centre-cropped to the preset's aspect ratio and
+# resized to it; a height of None keeps the source's aspect ratio and only fixes the width.
+EXPORT_PRESETS = {
+    'square': (1080, 1080),
+    'portrait': (1080, 1350),
+    'story': (1080, 1920),
+    'web': (1600, None),
+    'thumbnail': (400, None),
+}
+
+
+def encode_image(image, output_format='png', quality=90, compress_level=None, optimize=False):
+    # Returns the encoded bytes and their MIME type. compress_level (0-9) only applies to PNG, where None
+    # keeps zlib's default; quality only applies to JPEG and WebP. optimize trades encode time for size:
+    # an extra Huffman pass for JPEG, the slowest compression method for WebP and level 9 for PNG.
+    image_format, mime, _ = OUTPUT_FORMATS[output_format]
+    buffer = io.BytesIO()
+    if output_format == 'png':
+        if optimize:
+            image.save(buffer, format=image_format, optimize=True)
+        elif compress_level is None:
+            image.save(buffer, format=image_format)
+        else:
+            image.save(buffer, format=image_format, compress_level=compress_level)
+    elif output_format == 'jpeg':
+        image.convert('RGB').save(buffer, format=image_format, quality=quality, optimize=optimize)
+    else:
+        image.save(buffer, format=image_format, quality=quality, method=6 if optimize else 4)
+    return buffer.getvalue(), mime
+
+
+def preset_crop(size, target):
+    # The largest centred box of the source with the target's aspect ratio
+    width, height = size
+    target_width, target_height = target
+    if target_height is None:
+        return (0, 0, width, height)
+    if width * target_height > height * target_width:
+        crop_width = max(1, round(height * target_width / target_height))
+        left = (width - crop_width) // 2
+        return (left, 0, left + crop_width, height)
+    crop_height = max(1, round(width * target_height / target_width))
+    top = (height - crop_height) // 2
+    return (0, top, width, top + crop_height)
+
+
+def preset_size(crop, target):
+    target_width, target_height = target
+    if target_height is None:
+        return target_width, max(1, round((crop[3] - crop[1]) * target_width / (crop[2] - crop[0])))
+    return target
+
+
+def render_presets(image, text, settings, watermark_text='', presets=None):
+    # Yields (preset name, rendered image) for every preset as each is ready. Presets that share a crop
+    # are rendered once at the largest of their sizes and scaled down from that render. Each render is a
+    # proxy of its crop, as the preview is of the source: text is wrapped and sized for the crop at full
+    # resolution and scaled with it, so it matches a full-size render of that crop.
+    presets = EXPORT_PRESETS if presets is None else presets
+    groups = {}
+    for name, target in presets.items():
+        crop = preset_crop(image.size, target)
+        groups.setdefault(crop, []).append((name, preset_size(crop, target)))
+    # The layout and text raster don't depend on the pixels underneath, so crops of the same width share them
+    shared_layers = {}
+    for crop, members in groups.items():
+        members.sort(key=lambda member: member[1][0] * member[1][1], reverse=True)
+        (name, size), smaller = members[0], members[1:]
+        with span('preset_resize'):
+            variant = image.resize(size, Image.LANCZOS, box=crop, reducing_gap=2.0)
+        crop_size = (crop[2] - crop[0], crop[3] - crop[1])
+        previous = shared_layers.get(crop_size[0], {})
+        layers = {layer: previous[layer] for layer in ('layout', 'text') if layer in previous}
+        layers['source'] = variant
+        rendered = process_image(variant, text, settings, watermark_text, layers, full_size=crop_size)
+        shared_layers[crop_size[0]] = layers
+        yield name, rendered
+        for other_name, other_size in smaller:
+            with span('preset_resize'):
+                yield other_name, rendered.resize(other_size, Image.LANCZOS, reducing_gap=2.0)
+
+
+def export_presets(image, text, settings, watermark_text, output, presets=None, stem='image', output_format='png', quality=90,
+                   compress_level=None, optimize=False, workers=None):
+    # Writes every preset size of one image into a ZIP at output. Encodes run on threads, since Pillow
+    # releases the GIL while encoding, and overlap with the renders still to come. Members are stored,
+    # as the images are already compressed, and named stem_preset.ext in the order they were rendered.
+    workers = INGEST_WORKERS if workers is None else workers
+    extension = OUTPUT_FORMATS[output_format][2]
+    encode = partial(encode_image, output_format=output_format, quality=quality, compress_level=compress_level, optimize=optimize)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        encodes = [(name, pool.submit(encode, rendered)) for name, rendered in render_presets(image, text, settings, watermark_text, presets)]
+        with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for name, future in encodes:
+                archive.writestr(f"{stem}_{name}.{extension}", future.result()[0])
+    return [name for name, _ in encodes]
+
+
+def render_source(source, text, settings, watermark_text=''):
+    # Runs in a worker process: decodes, renders and encodes one image, returning only the PNG bytes
+    image = Image.open(io.BytesIO(source)).convert("RGB")
+    processed_image = process_image(image, text, settings, watermark_text)
+    return encode_image(processed_image)[0]
+
+
+def render_source_presets(source, text, settings, watermark_text='', presets=None):
+    # Worker-process counterpart of render_source for export presets: [(preset name, PNG bytes)]
+    image = Image.open(io.BytesIO(source)).convert("RGB")
+    return [(name, encode_image(rendered)[0]) for name, rendered in render_presets(image, text, settings, watermark_text, presets)]
+
+
+def unique_name(name, used):
+    # Members from different ZIPs can share a filename; suffix repeats instead of overwriting
+    base, ext = os.path.splitext(name)
+    candidate = name
+    count = 1
+    while candidate in used:
+        candidate = f"{base}_{count}{ext}"
+        count += 1
+    used.add(candidate)
+    return candidate
+
+
+def export_batch(image_data, settings, watermark_text, output, workers=None, progress=None, presets=None):
+    # Applies the same overlay settings to every image and streams each PNG into the ZIP at output
+    # as soon as it finishes. progress, if given, is called with (done, total) after every image.
+    # With presets, every image is written once per preset size instead, suffixed with the preset name.
+    # Sources are only read when their render is submitted, so at most the in-flight window is held in memory.
+    workers = INGEST_WORKERS if workers is None else workers
+    total = len(image_data)
+    used_names = set()
+    done = 0
+
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED) as archive:
+        # PNG data is already deflated, so members are stored rather than compressed again
+        def member_names(data):
+            # Worked out in input order as each render is submitted, so the name an image gets never depends
+            # on which render finishes first
+            stem = os.path.splitext(os.path.basename(data['filename']))[0]
+            if presets is None:
+                return {None: unique_name(f"overlay_{stem}.png", used_names)}
+            return {name: unique_name(f"overlay_{stem}_{name}.png", used_names) for name in presets}
+
+        def write(names, result):
+            nonlocal done
+            outputs = [(None, result)] if presets is None else result
+            for name, png_bytes in outputs:
+                archive.writestr(names[name], png_bytes)
+            done += 1
+            if progress is not None:
+                progress(done, total)
+
+        render = render_source if presets is None else partial(render_source_presets, presets=presets)
+        if workers <= 1:
+            for data in image_data:
+                write(member_names(data), render(data['source'].read(), data['description'], settings, watermark_text))
+            return done
+
+        executor = get_executor(workers)
+        window = workers * BATCH_INFLIGHT_PER_WORKER
+        pending = {}
+        remaining = iter(image_data)
+        while True:
+            for data in remaining:
+                future = executor.submit(render, data['source'].read(), data['description'], settings, watermark_text)
+                pending[future] = member_names(data)
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                write(pending.pop(future), future.result())
+
+    return done
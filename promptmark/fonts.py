@@ -0,0 +1,37 @@
+import os
+import string
+from functools import lru_cache
+from PIL import ImageFont
+from promptmark.trace import timed
+
+# Bundled fonts live next to the app, so headless runs find them from any working directory
+FONT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Characters sampled for the average width used to pick the wrap column
+AVERAGE_WIDTH_CHARS = string.ascii_lowercase + string.ascii_uppercase
+
+
+def resolve_font_path(font_path):
+    if os.path.exists(font_path):
+        return font_path
+    return os.path.join(FONT_DIR, font_path)
+
+
+@lru_cache(maxsize=128)
+@timed('font_load')
+def get_font(font_path, font_size):
+    # Loaded FreeType face plus the metrics every render needs, shared across sessions.
+    # The timer sits under the cache, so only actual font loads are recorded.
+    font = ImageFont.truetype(resolve_font_path(font_path), font_size)
+    advances = {char: font.getbbox(char)[2] for char in AVERAGE_WIDTH_CHARS}
+    return {
+        'font': font,
+        'line_height': font.getbbox('Ay')[3],
+        'advances': advances,
+        'average_char_width': sum(advances.values()) / len(advances)
+    }
+
+
+@lru_cache(maxsize=16384)
+def text_bbox(font_path, font_size, text, stroke_width=0):
+    return get_font(font_path, font_size)['font'].getbbox(text, stroke_width=stroke_width)
@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Decoded and rendered frames kept per session, and for every session of the server process together.
+# Frames are dropped least recently used first and decoded or rendered again when next needed.
+FRAME_SESSION_BUDGET_BYTES = int(os.environ.get('PROMPTMARK_FRAME_SESSION_BUDGET_BYTES', 256 * 1024 * 1024))
+FRAME_GLOBAL_BUDGET_BYTES = int(os.environ.get('PROMPTMARK_FRAME_GLOBAL_BUDGET_BYTES', 1024 * 1024 * 1024))
+
+_frame_cache = None
+_frame_cache_lock = threading.Lock()
+
+
+def frame_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class FrameCache:
+    # LRU cache of PIL images keyed by (session, kind, key), where kind says what the frame is, such as
+    # 'image' or 'preview', and key identifies what it was made from. A session over its own budget evicts
+    # its own frames; the process over the global budget evicts whichever session's frames are oldest.
+    # The frame just stored is never evicted, so a single frame larger than a budget still works.
+    # Frames of sessions that have ended are not removed explicitly, they simply age out.
+
+    def __init__(self, session_budget_bytes=FRAME_SESSION_BUDGET_BYTES, global_budget_bytes=FRAME_GLOBAL_BUDGET_BYTES):
+        self.session_budget_bytes = session_budget_bytes
+        self.global_budget_bytes = global_budget_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.session_sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session, kind, key, load):
+        # Returns the cached frame, or calls load() to make it and caches the result
+        entry_key = (session, kind, key)
+        with self.lock:
+            entry = self.entries.get(entry_key)
+            if entry is not None:
+                self.entries.move_to_end(entry_key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # Loaded outside the lock, since decoding or rendering can take a while
+        image = load()
+        self.put(session, kind, key, image)
+        return image
+
+    def put(self, session, kind, key, image):
+        entry_key = (session, kind, key)
+        size = frame_bytes(image)
+        with self.lock:
+            self.remove(entry_key)
+            self.entries[entry_key] = (image, size)
+            self.size += size
+            self.session_sizes[session] = self.session_sizes.get(session, 0) + size
+            if self.session_sizes[session] > self.session_budget_bytes:
+                for other_key in [other_key for other_key in self.entries if other_key[0] == session]:
+                    if self.session_sizes[session] <= self.session_budget_bytes or other_key == entry_key:
+                        break
+                    self.remove(other_key)
+                    self.evictions += 1
+            while self.size > self.global_budget_bytes and next(iter(self.entries)) != entry_key:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, entry_key):
+        # Callers hold the lock
+        entry = self.entries.pop(entry_key, None)
+        if entry is None:
+            return
+        session = entry_key[0]
+        self.size -= entry[1]
+        self.session_sizes[session] -= entry[1]
+        if not self.session_sizes[session]:
+            del self.session_sizes[session]
+
+    def usage(self, session=None):
+        # Current sizes and counters for the debug panel, optionally with one session's share
+        with self.lock:
+            usage = {'bytes': self.size, 'frames': len(self.entries), 'sessions': len(self.session_sizes),
+                     'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+            if session is not None:
+                usage['session_bytes'] = self.session_sizes.get(session, 0)
+                usage['session_frames'] = sum(1 for entry_key in self.entries if entry_key[0] == session)
+            return usage
+
+
+def get_frame_cache():
+    # One frame cache per server process, shared by all of its sessions
+    global _frame_cache
+    with _frame_cache_lock:
+        if _frame_cache is None:
+            _frame_cache = FrameCache()
+    return _frame_cache
@@ -0,0 +1,211 @@
+import base64
+import zipfile
+from promptmark.thumbnails import MIME_EXTENSIONS, build_sprite_atlas
+
+# Everything up to the page title; the CSS and the copy-to-clipboard script are shared by every page
+HTML_HEAD = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+    <style>
+    body {
+        font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+        margin: 0;
+        padding: 0;
+        color: #333;
+        max-width: 1000px;
+        margin: auto;
+        box-sizing: border-box;
+    }
+    h1 {
+        text-align: center;
+        font-size: 24px;
+        margin-top: 50px;
+    }
+    table {
+        width: 100%;
+        border-collapse: collapse;
+        margin-top: 20px;
+        margin-bottom: 50px;
+    }
+    table, th, td {
+        border: 1px solid #ddd;
+    }
+    th, td {
+        text-align: left;
+        padding: 8px;
+    }
+    tr:nth-child(even) {
+        background-color: #f2f2f2;
+    }
+    img {
+        width: 100px;
+        height: auto;
+        object-fit: contain;
+    }
+    .selectable {
+        user-select: all; 
+        cursor: pointer;
+    }
+    @media print {
+        body {
+            color: #000;
+        }
+        table {
+            width: 100%;
+            border: 1px solid #000;
+        }
+        th, td {
+            border: 1px solid #000;
+            padding: 10px;
+        }
+    }
+    @media only screen and (max-width: 600px) {
+        body {
+            max-width: 100%;
+            padding: 10px;
+            font-size: 16px;
+        }
+        h1 {
+            font-size: 20px;
+            margin-top: 20px;
+        }
+        table {
+            margin-top: 10px;
+            margin-bottom: 20px;
+        }
+        img {
+            width: 80px; /* smaller images on mobile */
+        }
+        th, td {
+            padding: 5px; /* smaller padding on mobile */
+        }
+        .selectable {
+            font-size: 14px; /* larger font size for readability on mobile */
+        }
+    }
+    </style>
+    <script>
+    function copyToClipboard(text) {
+        navigator.clipboard.writeText(text).then(function() {
+             alert('Copied to clipboard: ' + text);
+        }).catch(function(error) {
+            console.log('Copy to clipboard failed: ' + error);
+        });
+    }
+    </script>
+    </head>
+    <body>
+    """
+
+ROW_TEMPLATE = """
+        <tr>
+            <td><img src='{src}'{loading} onclick="copyToClipboard('{job_id}')"/></td>
+            <td onclick="copyToClipboard('{description}')" class="selectable">{description}</td>
+        </tr>
+        """
+
+# Sprite rows show their cell of a shared atlas image through CSS background offsets
+SPRITE_ROW_TEMPLATE = """
+        <tr>
+            <td><div class='sprite atlas-{atlas}' style='width: {width}px; height: {height}px; background-position: -{x}px -{y}px;' onclick="copyToClipboard('{job_id}')"></div></td>
+            <td onclick="copyToClipboard('{description}')" class="selectable">{description}</td>
+        </tr>
+        """
+
+
+def data_uri(mime, encoded):
+    return f"data:{mime};base64,{encoded}"
+
+
+def sprite_style(sprites, atlas_src):
+    rules = [".sprite { display: inline-block; background-repeat: no-repeat; cursor: pointer; }"]
+    for index, atlas in enumerate(sprites['atlases']):
+        rules.append(f".atlas-{index} {{ background-image: url('{atlas_src(index, atlas)}'); }}")
+    return "<style>\n    " + "\n    ".join(rules) + "\n    </style>\n    "
+
+
+def iter_html_table(image_data, custom_title, thumbnail_src=None, lazy=False, navigation='', sprites=None, atlas_src=None):
+    # Yields the gallery page piece by piece so it can be streamed to a file instead of built as one string.
+    # thumbnail_src maps a row to its image URL; by default thumbnails are inlined as data URIs.
+    # With sprites from build_sprite_atlas, rows point into the atlases instead, which atlas_src maps to URLs.
+    head = HTML_HEAD
+    if sprites is not None:
+        if atlas_src is None:
+            atlas_src = lambda index, atlas: data_uri(atlas['mime'], base64.b64encode(atlas['data']).decode('utf-8'))
+        head += sprite_style(sprites, atlas_src)
+    yield head + "<h1>" + custom_title + """</h1>
+    <table>
+    """
+    loading = " loading='lazy'" if lazy else ""
+    for data in image_data:
+        if sprites is not None:
+            atlas, x, y, width, height = sprites['cells'][data['key']]
+            yield SPRITE_ROW_TEMPLATE.format(atlas=atlas, x=x, y=y, width=width, height=height,
+                                             job_id=data['job_id'], description=data['description'])
+            continue
+        if thumbnail_src is None:
+            src = data_uri(data.get('thumbnail_mime', 'image/png'), data['thumbnail'])
+        else:
+            src = thumbnail_src(data)
+        yield ROW_TEMPLATE.format(src=src, loading=loading, job_id=data['job_id'], description=data['description'])
+
+    # Close the table and HTML tags
+    yield "</table>" + navigation + "</body></html>"
+
+
+def create_html_table(image_data, custom_title):
+    return "".join(iter_html_table(image_data, custom_title))
+
+
+def write_html_table(image_data, custom_title, output, sprites=False):
+    # Streams the single-page gallery into a binary file object, optionally packing thumbnails into atlases
+    atlases = build_sprite_atlas(image_data) if sprites else None
+    for chunk in iter_html_table(image_data, custom_title, sprites=atlases):
+        output.write(chunk.encode('utf-8'))
+
+
+def page_name(page):
+    return f"page-{page:04d}.html"
+
+
+def page_navigation(page, page_count):
+    links = []
+    if page > 1:
+        links.append(f"<a href='{page_name(page - 1)}'>&laquo; Previous</a>")
+    links.append(f"Page {page} of {page_count}")
+    if page < page_count:
+        links.append(f"<a href='{page_name(page + 1)}'>Next &raquo;</a>")
+    return "<p style='text-align: center; margin-bottom: 50px;'>" + " | ".join(links) + "</p>"
+
+
+def thumbnail_file(data):
+    return f"thumbnails/{data['key']}.{MIME_EXTENSIONS[data.get('thumbnail_mime', 'image/png')]}"
+
+
+def write_gallery_pages(image_data, custom_title, output, rows_per_page=100, sprites=False):
+    # Writes a ZIP of linked pages of rows_per_page rows each. Thumbnails (or one atlas per page) are
+    # stored as separate files and lazy-loaded, so each page stays small however large the collection is.
+    page_count = max(1, -(-len(image_data) // rows_per_page))
+    written = set()
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for page in range(1, page_count + 1):
+            rows = image_data[(page - 1) * rows_per_page:page * rows_per_page]
+            atlases = None
+            atlas_src = None
+            if sprites:
+                atlases = build_sprite_atlas(rows)
+                atlas_src = lambda index, atlas: f"thumbnails/atlas-{page:04d}-{index}.{MIME_EXTENSIONS[atlas['mime']]}"
+                for index, atlas in enumerate(atlases['atlases']):
+                    archive.writestr(atlas_src(index, atlas), atlas['data'], compress_type=zipfile.ZIP_STORED)
+            else:
+                for data in rows:
+                    if data['key'] not in written:
+                        archive.writestr(thumbnail_file(data), base64.b64decode(data['thumbnail']), compress_type=zipfile.ZIP_STORED)
+                        written.add(data['key'])
+            with archive.open(page_name(page), 'w') as page_file:
+                for chunk in iter_html_table(rows, custom_title, thumbnail_file, lazy=True, navigation=page_navigation(page, page_count),
+                                             sprites=atlases, atlas_src=atlas_src):
+                    page_file.write(chunk.encode('utf-8'))
+        # Opening the archive lands on the first page
+        archive.writestr("index.html", f"<!DOCTYPE html><meta http-equiv='refresh' content='0; url={page_name(1)}'>")
@@ -0,0 +1,322 @@
+import os
+import io
+import re
+import base64
+import hashlib
+import struct
+import zipfile
+import zlib
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from PIL import Image
+from promptmark.dedupe import NearDuplicateIndex, difference_hash, thumbnail_hash
+from promptmark.sources import FileSource, archive_images, cached_content_key, remember_content_key
+from promptmark.thumbnails import encode_thumbnail, make_thumbnail
+from promptmark.trace import span
+
+# Defaults for parallel ingest, overridable per deployment through the environment
+INGEST_WORKERS = int(os.environ.get('PROMPTMARK_INGEST_WORKERS', os.cpu_count() or 1))
+INGEST_CHUNK_SIZE = int(os.environ.get('PROMPTMARK_INGEST_CHUNK_SIZE', 8))
+# Workers start from a clean server process rather than a fork of this one: the Streamlit server is
+# multithreaded, and a fork taken while another thread holds a lock leaves that lock held in the child
+POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+# Below this many files the pool start-up and pickling cost more than they save
+PARALLEL_INGEST_MIN_FILES = 16
+# Image bytes kept between hashing and decoding new images; beyond this they are read again from their source
+INGEST_HOLD_BYTES = int(os.environ.get('PROMPTMARK_INGEST_HOLD_BYTES', 64 * 1024 * 1024))
+
+_executor = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+def extract_job_id(metadata):
+    # Attempt to find a job ID in the image metadata description
+    description = metadata.get('Description', '')
+    job_id_match = re.search(r"Job ID: ([\w-]+)", description)
+    return job_id_match.group(1) if job_id_match else "No Job ID Found"
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+EXIF_IMAGE_DESCRIPTION = 0x010E
+
+def read_png_text(data):
+    # Walk the whole chunk list, decoding only the text chunks. Text may also follow the image data, so IDAT
+    # chunks are stepped over by their length rather than ending the walk; they are never sliced or inflated
+    metadata = {}
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        if chunk_type == b'IEND':
+            break
+        if chunk_type not in (b'tEXt', b'zTXt', b'iTXt'):
+            offset += 12 + length
+            continue
+        chunk = data[offset + 8:offset + 8 + length]
+        offset += 12 + length
+        try:
+            if chunk_type == b'tEXt':
+                key, value = chunk.split(b'\0', 1)
+                metadata[key.decode('latin-1')] = value.decode('latin-1')
+            elif chunk_type == b'zTXt':
+                key, value = chunk.split(b'\0', 1)
+                metadata[key.decode('latin-1')] = zlib.decompress(value[1:]).decode('latin-1')
+            elif chunk_type == b'iTXt':
+                key, value = chunk.split(b'\0', 1)
+                compressed = value[0]
+                _, _, value = value[2:].split(b'\0', 2)
+                if compressed:
+                    value = zlib.decompress(value)
+                metadata[key.decode('latin-1')] = value.decode('utf-8')
+        except (ValueError, IndexError, zlib.error):
+            continue  # Skip malformed text chunks the same way Pillow does
+    return metadata
+
+def read_exif_description(exif):
+    # Look up ImageDescription in IFD0 of a TIFF-structured EXIF block
+    byte_order = '<' if exif[:2] == b'II' else '>'
+    ifd_offset = struct.unpack(byte_order + 'I', exif[4:8])[0]
+    entry_count = struct.unpack(byte_order + 'H', exif[ifd_offset:ifd_offset + 2])[0]
+    for i in range(entry_count):
+        entry = exif[ifd_offset + 2 + i * 12:ifd_offset + 14 + i * 12]
+        tag, field_type, count = struct.unpack(byte_order + 'HHI', entry[:8])
+        if tag == EXIF_IMAGE_DESCRIPTION and field_type == 2:
+            if count <= 4:
+                value = entry[8:8 + count]
+            else:
+                value_offset = struct.unpack(byte_order + 'I', entry[8:12])[0]
+                value = exif[value_offset:value_offset + count]
+            return value.rstrip(b'\0').decode('utf-8', errors='replace')
+    return None
+
+def read_jpeg_text(data):
+    # Walk the marker segments up to the start of scan, collecting COM and EXIF descriptions
+    metadata = {}
+    offset = 2
+    while offset + 4 <= len(data) and data[offset] == 0xFF:
+        marker = data[offset + 1]
+        if marker == 0xDA or marker == 0xD9:
+            break
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        segment = data[offset + 4:offset + 2 + length]
+        offset += 2 + length
+        if marker == 0xFE:
+            metadata['comment'] = segment.decode('utf-8', errors='replace')
+        elif marker == 0xE1 and segment.startswith(b'Exif\0\0'):
+            try:
+                description = read_exif_description(segment[6:])
+            except struct.error:
+                description = None
+            if description:
+                metadata['Description'] = description
+    if 'Description' not in metadata and 'comment' in metadata:
+        metadata['Description'] = metadata['comment']
+    return metadata
+
+def read_image_metadata(data):
+    # Header-only metadata scan: never touches the compressed pixel data
+    if data.startswith(PNG_SIGNATURE):
+        return read_png_text(data)
+    if data.startswith(b'\xff\xd8'):
+        return read_jpeg_text(data)
+    return Image.open(io.BytesIO(data)).info
+
+def ingest_source(data, thumbnail_encoder=None, thumbnail_quality=None):
+    # Runs in a worker process: everything here must be picklable in and out
+    metadata = read_image_metadata(data)
+    job_id = extract_job_id(metadata)
+    description = metadata.get('Description', 'No Description Found').split('Job ID:')[0].strip()
+    img = make_thumbnail(Image.open(io.BytesIO(data)))
+    thumb_bytes, thumb_mime = encode_thumbnail(img, thumbnail_encoder, thumbnail_quality)
+    thumbnail = base64.b64encode(thumb_bytes).decode('utf-8')
+    return {
+        'thumbnail': thumbnail,
+        'thumbnail_mime': thumb_mime,
+        'description': description,
+        'job_id': job_id,
+        # Hashed from the thumbnail that is already decoded, so near-duplicate detection costs no extra decode
+        'dhash': difference_hash(img)
+    }
+
+def get_executor(workers):
+    # One process pool per server process, shared by all of its sessions. It is rebuilt when the worker count
+    # changes, and when a worker has died (to the OOM killer, say): a broken pool refuses all further work
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers or getattr(_executor, '_broken', False):
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(POOL_START_METHOD))
+            _executor_workers = workers
+        return _executor
+
+def ingest_chunk(chunk, thumbnail_encoder=None, thumbnail_quality=None):
+    return [ingest_source(data, thumbnail_encoder, thumbnail_quality) for data in chunk]
+
+def ingest_sources(sources, workers=None, chunksize=None, thumbnail_encoder=None, thumbnail_quality=None, count=None):
+    # sources is an iterable of image bytes, consumed only as far as the work in flight needs, so a generator
+    # that reads each image on demand keeps memory bounded. count is its length when it isn't a sequence.
+    # Results come back in the same order as sources, whether or not a pool is used
+    workers = INGEST_WORKERS if workers is None else workers
+    chunksize = max(1, INGEST_CHUNK_SIZE if chunksize is None else chunksize)
+    count = len(sources) if count is None else count
+    if workers <= 1 or count < PARALLEL_INGEST_MIN_FILES:
+        return [ingest_source(data, thumbnail_encoder, thumbnail_quality) for data in sources]
+    executor = get_executor(workers)
+    ingest = partial(ingest_chunk, thumbnail_encoder=thumbnail_encoder, thumbnail_quality=thumbnail_quality)
+    results = []
+    pending = deque()
+    chunk = []
+    for data in sources:
+        chunk.append(data)
+        if len(chunk) == chunksize:
+            pending.append(executor.submit(ingest, chunk))
+            chunk = []
+            # Two chunks per worker keeps every worker busy while one chunk's results travel back
+            if len(pending) >= workers * 2:
+                results.extend(pending.popleft().result())
+    if chunk:
+        pending.append(executor.submit(ingest, chunk))
+    while pending:
+        results.extend(pending.popleft().result())
+    return results
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class IngestCache:
+    # Ingest results keyed by content hash and thumbnail encoder, evicting least recently used files over budget_bytes
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if key in self.entries:
+            return
+        self.entries[key] = entry
+        self.size += entry['size']
+        # Evict least recently used files until we are back under budget, always keeping the newest one
+        while self.size > self.budget_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted['size']
+
+
+def process_images(uploaded_files, cache=None, workers=None, chunksize=None, thumbnail_encoder=None, thumbnail_quality=None, store=None, skip_duplicates=False, near_duplicates=None):
+    # uploaded_files are binary file objects with a name: Streamlit uploads or files opened from disk. Records
+    # refer to their image through a 'source' with a read() method, so the files must stay open while they are used.
+    # Results are looked up in the in-memory cache, then in the persistent store, before anything is decoded.
+    # Identical content is only ever decoded once; with skip_duplicates it is also listed only once.
+    # Every record gets a 'group' naming the first image it is a near-duplicate of, or its own key. Passing a
+    # NearDuplicateIndex that lives across calls keeps groups stable and only indexes images not seen before.
+    image_data = []
+    dates = set()
+    total_images = 0
+
+    # Gather every image in upload order as a reference that is read again on demand. Bytes are only held
+    # until hashed, except that images missing from the cache keep theirs for the decode while they fit
+    # in INGEST_HOLD_BYTES; the rest are read a second time when they are decoded.
+    # The same content encoded with another thumbnail encoder is a different cache entry
+    encoder_key = (thumbnail_encoder, thumbnail_quality)
+    pending = []
+    entries = {}
+    misses = {}
+    held = {}
+    held_bytes = 0
+    filenames = {}
+    for uploaded_file in uploaded_files:
+        match = re.search(r"(\d{4}-\d{1,2}-\d{1,2})_\[(\d+)-(\d+)\]", os.path.basename(uploaded_file.name))
+        date = None
+        if match:
+            dates.add(match.group(1))
+            date = match.group(1)
+            start_range, end_range = int(match.group(2)), int(match.group(3))
+            total_images += (end_range - start_range + 1)
+
+        if zipfile.is_zipfile(uploaded_file):
+            sources = [(source, file_name, True) for source, file_name in archive_images(uploaded_file)]
+        else:
+            total_images += 1
+            sources = [(FileSource(uploaded_file), os.path.basename(uploaded_file.name), False)]
+
+        for source, file_name, is_zip in sources:
+            # Uploads seen on an earlier rerun already have their key, and are only read if they must be decoded
+            key = cached_content_key(source.identity)
+            data = None
+            if key is None:
+                with span('ingest_hash'):
+                    data = source.read()
+                    key = content_hash(data)
+                remember_content_key(source.identity, key)
+            pending.append((key, source, file_name, is_zip, date))
+            filenames[key] = file_name
+            if key not in entries and key not in misses:
+                entry = cache.get((key, encoder_key)) if cache is not None else None
+                if entry is None:
+                    misses[key] = source
+                    if data is not None and held_bytes + len(data) <= INGEST_HOLD_BYTES:
+                        held[key] = data
+                        held_bytes += len(data)
+                else:
+                    entries[key] = entry
+
+    stored = {}
+    if store is not None and misses:
+        with span('ingest_store_read'):
+            stored = store.get_many(misses, repr(encoder_key))
+    decode = [key for key in misses if key not in stored]
+    with span('ingest_decode'):
+        data = (held.pop(key, None) or misses[key].read() for key in decode)
+        results = dict(zip(decode, ingest_sources(data, workers, chunksize, thumbnail_encoder, thumbnail_quality, len(decode))))
+    if store is not None and results:
+        with span('ingest_store_write'):
+            store.put_many({key: (filenames[key], result) for key, result in results.items()}, repr(encoder_key))
+    for key in misses:
+        result = stored.get(key) or results[key]
+        if result.get('dhash') is None:
+            result = dict(result, dhash=thumbnail_hash(result['thumbnail']))
+        entries[key] = dict(result, size=len(result['thumbnail']))
+        if cache is not None:
+            cache.put((key, encoder_key), entries[key])
+
+    near_duplicates = NearDuplicateIndex() if near_duplicates is None else near_duplicates
+    listed = set()
+    for key, source, file_name, is_zip, date in pending:
+        if skip_duplicates and key in listed:
+            continue
+        listed.add(key)
+        entry = entries[key]
+        image_data.append({
+            'source': source,
+            'filename': file_name,
+            'thumbnail': entry['thumbnail'],
+            'thumbnail_mime': entry['thumbnail_mime'],
+            'description': entry['description'],
+            'job_id': entry['job_id'],
+            'is_zip': is_zip,
+            'date': date,
+            'dhash': entry['dhash'],
+            'group': near_duplicates.add(key, entry['dhash']),
+            'key': key
+        })
+
+    if dates:
+        dates_str = '_'.join(sorted(dates))
+        html_file_name = f"{dates_str}-[{total_images}].html"
+    else:
+        html_file_name = "image_metadata.html"
+
+    return image_data, html_file_name, total_images
@@ -0,0 +1,266 @@
+import os
+import textwrap
+from functools import lru_cache
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFilter
+from promptmark.fonts import get_font, text_bbox
+from promptmark.trace import span, timed
+
+# Large backdrops with a large blur radius are blurred at reduced size and scaled back up, a few times faster
+# at 4K and 8K and within a few levels of the exact blur. PROMPTMARK_BLUR_MODE=exact or approximate forces either.
+BLUR_MODE = os.environ.get('PROMPTMARK_BLUR_MODE', 'auto').lower()
+BLUR_APPROXIMATE_MIN_RADIUS = 16
+BLUR_APPROXIMATE_MIN_PIXELS = 1_000_000
+# Radius the approximate blur runs at once the backdrop is downsampled
+BLUR_REDUCED_RADIUS = 8
+
+
+class RenderCancelled(Exception):
+    pass
+
+
+def cached_layer(layers, name, key, build, cancelled=None):
+    # Each layer keeps only its latest result; it is rebuilt when the settings it depends on change.
+    # cancelled, if given, is checked before any layer is built, so an outdated render stops between stages.
+    if layers is not None:
+        cached = layers.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+    if cancelled is not None and cancelled():
+        raise RenderCancelled(name)
+    value = build()
+    if layers is None:
+        return value
+    layers[name] = (key, value)
+    return value
+
+
+def wrap_width_chars(font_path, font_size, wrap_width_percentage, image_width):
+    # Calculate the width of the area to wrap the text in pixels, then convert it to a column count
+    adjusted_wrap_percentage = min(1.6, (wrap_width_percentage / 100) * 1.2)
+    wrap_area_width_px = int(image_width * adjusted_wrap_percentage)
+    return max(1, int(wrap_area_width_px / get_font(font_path, font_size)['average_char_width']))
+
+
+@lru_cache(maxsize=256)
+def wrap_lines(text, wrap_chars):
+    # Line breaks only depend on the column count, so renders of the same text at other sizes share them
+    return tuple(textwrap.fill(text, width=wrap_chars).split('\n'))
+
+
+@timed('wrap')
+def layout_text(text, font_path, font_size, wrap_chars, line_spacing_percentage):
+    line_height = get_font(font_path, font_size)['line_height']
+    line_spacing = int(line_height * (line_spacing_percentage / 100.0))
+    wrapped_lines = wrap_lines(text, wrap_chars)
+    line_bboxes = [text_bbox(font_path, font_size, line) for line in wrapped_lines]
+
+    return {
+        'lines': wrapped_lines,
+        'line_bboxes': line_bboxes,
+        'line_height': line_height,
+        'line_spacing': line_spacing,
+        'width': max(bbox[2] for bbox in line_bboxes),
+        'height': sum([bbox[3] + bbox[1] for bbox in line_bboxes]) + (len(wrapped_lines) - 1) * (line_spacing - line_height)
+    }
+
+
+def blur_factor(radius, size, mode=None):
+    # Downsampling factor for the blur; 1 means the exact blur
+    mode = BLUR_MODE if mode is None else mode
+    if mode == 'exact':
+        return 1
+    if mode == 'auto' and (radius < BLUR_APPROXIMATE_MIN_RADIUS or size[0] * size[1] < BLUR_APPROXIMATE_MIN_PIXELS):
+        return 1
+    return max(1, min(int(radius // BLUR_REDUCED_RADIUS), size[0], size[1]))
+
+
+@timed('blur')
+def blur_backdrop(image, box, radius, mode=None):
+    backdrop = image.crop(box)
+    factor = blur_factor(radius, backdrop.size, mode)
+    if factor > 1:
+        # Box-reduce, blur with the radius scaled down to match, then scale the reduced area back up over the full box
+        width, height = backdrop.size
+        blurred = backdrop.reduce(factor).filter(ImageFilter.GaussianBlur(radius=radius / factor))
+        blurred = blurred.resize((width, height), Image.BILINEAR, box=(0, 0, width / factor, height / factor))
+    else:
+        blurred = backdrop.filter(ImageFilter.GaussianBlur(radius=radius))
+    return blurred if blurred.mode == "RGB" else blurred.convert("RGB")
+
+
+@lru_cache(maxsize=16)
+def rounded_mask(width, height, radius):
+    # Mask for the blurred background to maintain rounded corners
+    mask = Image.new("L", (width, height), 0)
+    mask_draw = ImageDraw.Draw(mask)
+    mask_draw.rounded_rectangle([(0, 0), (width, height)], radius=radius, fill=255)
+    return mask
+
+
+@lru_cache(maxsize=64)
+def backdrop_table(brightness, tint, tint_color, tint_opacity):
+    # Brightness and tint only depend on each channel's own value, so both fold into one 256-entry table per
+    # channel. The table repeats the float32 arithmetic and truncation of ImageEnhance.Brightness and
+    # ImageChops.blend, so applying it matches them exactly.
+    values = np.tile(np.arange(256, dtype=np.float32), (3, 1))
+    if brightness != 0:
+        # Brightness is a value between 0.0 (black image) and 2.0 or higher (increased brightness), with 1 being the original image
+        values = np.floor(np.minimum(values * np.float32(1 + brightness / 255), 255))
+    if tint:
+        tint_rgb = np.array(ImageColor.getrgb(tint_color)[:3], dtype=np.float32)[:, None]
+        values = np.floor(np.clip(values + np.float32(tint_opacity) * (tint_rgb - values), 0, 255))
+    return values.astype(np.uint8).ravel().tolist()
+
+
+@timed('brightness_tint')
+def adjust_backdrop(blurred_background, brightness, tint, tint_color, tint_opacity, corner_radius):
+    # One table lookup applies brightness and tint, and the rounded-corner mask becomes the alpha channel,
+    # so the result is composited by pasting it with itself as the mask
+    if brightness != 0 or tint:
+        adjusted = blurred_background.point(backdrop_table(brightness, tint, tint_color, tint_opacity))
+    else:
+        adjusted = blurred_background.convert("RGBA")
+    adjusted.putalpha(rounded_mask(adjusted.width, adjusted.height, corner_radius))
+    return adjusted
+
+
+@timed('text_raster')
+def render_text_layer(layout, font_path, font_size, text_color, stroke_width, stroke_color, image_width):
+    # Lines are drawn into a transparent strip as wide as the image, padded so strokes and descenders fit.
+    # Returns the strip and the offset of the first line's baseline origin within it.
+    font = get_font(font_path, font_size)['font']
+    offset = layout['line_height'] + stroke_width
+    bottom = max(bbox[3] for bbox in layout['line_bboxes']) + stroke_width
+    height = offset + max(0, layout['line_spacing']) * (len(layout['lines']) - 1) + bottom
+    text_layer = Image.new("RGBA", (image_width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(text_layer)
+    current_y = offset
+    for line, bbox in zip(layout['lines'], layout['line_bboxes']):
+        text_x = (image_width - bbox[2]) // 2
+
+        # Outline text if stroke width is greater than 0
+        if stroke_width > 0:
+            draw.text((text_x, current_y), line, font=font, fill=stroke_color, stroke_width=stroke_width)
+
+        # Draw the main text
+        draw.text((text_x, current_y), line, fill=text_color, font=font)
+        current_y += layout['line_spacing']  # Increment y position for the next line
+    return text_layer, offset
+
+
+@lru_cache(maxsize=32)
+def watermark_sprite(watermark_text, font_path, font_size, stroke_color, stroke_width):
+    # Stroke-only text rasterized once into a transparent sprite just big enough for it, shared by every
+    # image drawn with the same corner text. Returns the sprite and the text box it covers.
+    watermark_bbox = text_bbox(font_path, font_size, watermark_text, stroke_width)
+    sprite = Image.new('RGBA', (watermark_bbox[2] - watermark_bbox[0], watermark_bbox[3] - watermark_bbox[1]), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(sprite)
+    draw.text((-watermark_bbox[0], -watermark_bbox[1]), watermark_text, font=get_font(font_path, font_size)['font'],
+              fill=(0, 0, 0, 0), stroke_width=stroke_width, stroke_fill=stroke_color)
+    return sprite, watermark_bbox
+
+
+@timed('watermark')
+def add_watermark(image, watermark_text, font_path, font_size, stroke_color, overlay_position, scale=1):
+    if not watermark_text:
+        return image
+    width, height = image.size
+    stroke_width = max(1, round(3 * scale))
+    edge = round(10 * scale)
+
+    sprite, watermark_bbox = watermark_sprite(watermark_text, font_path, font_size, stroke_color, stroke_width)
+    text_width = watermark_bbox[2] - watermark_bbox[0]
+    text_height = watermark_bbox[3] - watermark_bbox[1]
+
+    # Calculate position for watermark to avoid being cut off
+    x = max(width - text_width - stroke_width - edge, 0)  # 10 pixels from the right edge at full scale
+    if overlay_position == "Top":
+        y = edge
+    else:
+        y = max(height - text_height - stroke_width - edge, 0)  # Place watermark at the bottom edge
+
+    # Paste the sprite where the text would have been drawn, so only that corner is blended
+    image.paste(sprite, (x + watermark_bbox[0], y + watermark_bbox[1]), sprite)
+
+    return image
+
+
+def overlay_text_on_image(image, text, font_path, font_size, text_color, wrap_width_percentage, stroke_width, stroke_color, overlay_position, brightness, vertical_padding, horizontal_padding, overlay_margin, tint_color, tint_opacity, line_spacing_percentage, tint=False, layers=None, wrap_chars=None, cancelled=None):
+    # The source image is left untouched. With a layers dict, every stage is cached on just the
+    # settings it depends on, so changing one setting only recomputes the stages downstream of it.
+    # wrap_chars pins the line breaks, so a scaled-down proxy wraps exactly like the full-size render.
+    # cancelled is a callable returning True once the render is no longer wanted; see cached_layer.
+    if wrap_chars is None:
+        wrap_chars = wrap_width_chars(font_path, font_size, wrap_width_percentage, image.width)
+    layout_key = (text, font_path, font_size, wrap_chars, line_spacing_percentage)
+    layout = cached_layer(layers, 'layout', layout_key, lambda: layout_text(
+        text, font_path, font_size, wrap_chars, line_spacing_percentage), cancelled)
+
+    # Convert padding percentages to pixel values
+    vertical_padding_px = int(image.height * (vertical_padding / 100))
+    horizontal_padding_px = int(image.width * (horizontal_padding / 100))
+
+    # Calculate the width and height of the blurred background
+    bg_width = layout['width'] + horizontal_padding_px * 2
+    bg_height = layout['height'] + vertical_padding_px * 2
+
+    # Convert margin percentage to pixel value and calculate the position
+    max_margin = (image.height - bg_height) / 2
+    overlay_margin_px = int(max_margin * (overlay_margin / 100))
+
+    # Calculate the position for the background
+    bg_x = (image.width - bg_width) // 2
+    if overlay_position == "Top":
+        bg_y = overlay_margin_px
+    else:
+        bg_y = image.height - bg_height - overlay_margin_px
+
+    # Crop and blur the background area, then adjust brightness and tint
+    box = (bg_x, bg_y, bg_x + bg_width, bg_y + bg_height)
+    blur_radius = min(horizontal_padding_px, vertical_padding_px) // 2
+    backdrop_key = (box, blur_radius)
+    blurred_background = cached_layer(layers, 'backdrop', backdrop_key, lambda: blur_backdrop(image, box, blur_radius), cancelled)
+    corner_radius = max(vertical_padding_px, horizontal_padding_px) // 2
+    adjusted_key = (backdrop_key, brightness, tint, tint_color, tint_opacity, corner_radius)
+    adjusted_background = cached_layer(layers, 'adjusted', adjusted_key, lambda: adjust_backdrop(
+        blurred_background, brightness, tint, tint_color, tint_opacity, corner_radius), cancelled)
+
+    text_key = (layout_key, text_color, stroke_width, stroke_color, image.width)
+    text_layer, text_offset = cached_layer(layers, 'text', text_key, lambda: render_text_layer(
+        layout, font_path, font_size, text_color, stroke_width, stroke_color, image.width), cancelled)
+
+    # Paste the blurred background and the text raster onto a copy of the source
+    with span('composite'):
+        result = image.copy()
+        result.paste(adjusted_background, (bg_x, bg_y), adjusted_background)
+        result.paste(text_layer, (0, bg_y + vertical_padding_px - text_offset), text_layer)
+
+    return result
+
+
+def process_image(image, text, settings, watermark_text='', layers=None, full_size=None, cancelled=None):
+    expected_keys = ['font_path', 'font_size', 'text_color', 'wrap_width_percentage', 'stroke_width', 'stroke_color', 'overlay_position', 'brightness', 'vertical_padding', 'horizontal_padding', 'overlay_margin', 'tint_color', 'tint_opacity', 'line_spacing_percentage']
+    filtered_settings = {key: settings[key] for key in expected_keys if key in settings}
+    # When rendering a proxy of a full_size original, pixel sizes shrink with it while padding and margin,
+    # being percentages of the image, scale on their own. Wrapping is pinned to the full-size line breaks.
+    scale = 1
+    wrap_chars = None
+    if full_size is not None and full_size[0] != image.width:
+        scale = image.width / full_size[0]
+        wrap_chars = wrap_width_chars(settings['font_path'], settings['font_size'], settings['wrap_width_percentage'], full_size[0])
+        filtered_settings['font_size'] = max(1, round(settings['font_size'] * scale))
+        if settings['stroke_width'] > 0:
+            filtered_settings['stroke_width'] = max(1, round(settings['stroke_width'] * scale))
+    watermark_size = max(1, round(settings.get('watermark_size', 24) * scale))
+    # Cached layers belong to one source image; start over when a different one is rendered
+    if layers is not None and layers.get('source') is not image:
+        layers.clear()
+        layers['source'] = image
+    if not settings['include_overlay']:
+        return add_watermark(image.copy(), watermark_text, settings['font_path'], watermark_size, settings['text_color'], settings['overlay_position'], scale)
+
+    updated_image = overlay_text_on_image(image, text, tint=settings.get('tint', False), layers=layers, wrap_chars=wrap_chars, cancelled=cancelled, **filtered_settings)
+    if watermark_text:
+        updated_image = add_watermark(updated_image, watermark_text, filtered_settings['font_path'], watermark_size, settings['text_color'], filtered_settings['overlay_position'], scale)
+    return updated_image
@@ -0,0 +1,140 @@
+import re
+from bisect import bisect_left, bisect_right
+
+TOKEN_PATTERN = re.compile(r"[0-9a-z]+")
+
+# Shorter query words only match whole words, since a one-letter prefix matches nearly everything
+MIN_PREFIX_LENGTH = 2
+
+# Prefix expansions kept between queries, which is what typing a word one letter at a time repeats
+PREFIX_CACHE_SIZE = 256
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def normalize_date(date):
+    # Upload names write dates like 2024-1-5; zero-padding them makes string order the same as date order
+    year, month, day = date.split('-')
+    return f"{int(year):04d}-{int(month):02d}-{int(day):02d}"
+
+
+def prefix_range(sorted_terms, prefix):
+    start = bisect_left(sorted_terms, prefix)
+    end = bisect_left(sorted_terms, prefix + '\uffff', start)
+    return sorted_terms[start:end]
+
+
+class SearchIndex:
+    # Inverted index over the records produced by process_images, keyed by their content key.
+    # Descriptions, job IDs and filenames feed one word index; job IDs also get their own, and upload
+    # dates a sorted date index. Records are added incrementally as new files arrive.
+    #
+    # Query words are ANDed and match by prefix once they are MIN_PREFIX_LENGTH long. job:WORD only
+    # matches job IDs, and date:YYYY-MM-DD or date:FROM..TO (either end may be left out) matches upload dates.
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.words = {}
+        self.job_words = {}
+        self.dates = {}
+        self.keys = set()
+        self.sorted_words = []
+        self.sorted_job_words = []
+        self.sorted_dates = []
+        self.prefix_cache = {}
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, records):
+        for record in records:
+            key = record['key']
+            if key in self.keys:
+                continue
+            self.keys.add(key)
+            job_tokens = tokenize(record.get('job_id'))
+            for token in set(tokenize(record.get('description')) + job_tokens + tokenize(record.get('filename'))):
+                self.words.setdefault(token, set()).add(key)
+            for token in set(job_tokens):
+                self.job_words.setdefault(token, set()).add(key)
+            if record.get('date'):
+                self.dates.setdefault(normalize_date(record['date']), set()).add(key)
+            self.dirty = True
+
+    def sync(self, image_data):
+        # Adds records not seen yet. Keys of images no longer loaded are harmless, since results are only
+        # used to filter the loaded images, but once they outnumber those the index is rebuilt.
+        live_keys = {record['key'] for record in image_data}
+        if len(self.keys) > 2 * len(live_keys):
+            self.clear()
+        self.add(record for record in image_data if record['key'] not in self.keys)
+
+    def refresh(self):
+        # Sorted term lists back the prefix and range lookups; they are rebuilt lazily after additions
+        if self.dirty:
+            self.sorted_words = sorted(self.words)
+            self.sorted_job_words = sorted(self.job_words)
+            self.sorted_dates = sorted(self.dates)
+            self.prefix_cache.clear()
+            self.dirty = False
+
+    def match_prefix(self, postings, sorted_terms, prefix):
+        if len(prefix) < MIN_PREFIX_LENGTH:
+            return postings.get(prefix, set())
+        cache_key = (id(postings), prefix)
+        matches = self.prefix_cache.get(cache_key)
+        if matches is None:
+            terms = prefix_range(sorted_terms, prefix)
+            matches = postings[terms[0]] if len(terms) == 1 else set().union(*(postings[term] for term in terms))
+            if len(self.prefix_cache) >= PREFIX_CACHE_SIZE:
+                self.prefix_cache.pop(next(iter(self.prefix_cache)))
+            self.prefix_cache[cache_key] = matches
+        return matches
+
+    def match_dates(self, value):
+        start, _, end = value.partition('..')
+        try:
+            start = normalize_date(start) if start else ''
+            end = normalize_date(end) if end else '\uffff'
+        except ValueError:
+            return set()
+        if '..' not in value:
+            end = start
+        dates = self.sorted_dates[bisect_left(self.sorted_dates, start):bisect_right(self.sorted_dates, end)]
+        return set().union(*(self.dates[date] for date in dates))
+
+    def search(self, query):
+        # Returns the set of matching keys, or None for an empty query. The set may be shared, so it must not be modified.
+        self.refresh()
+        candidates = []
+        for term in query.split():
+            field, _, value = term.partition(':')
+            if value and field.lower() == 'date':
+                candidates.append(self.match_dates(value))
+            elif value and field.lower() == 'job':
+                candidates.extend(self.match_prefix(self.job_words, self.sorted_job_words, token) for token in tokenize(value))
+            else:
+                candidates.extend(self.match_prefix(self.words, self.sorted_words, token) for token in tokenize(term))
+        if not candidates:
+            return None
+        # Intersect smallest first, so the work is bounded by the rarest term
+        candidates.sort(key=len)
+        matches = candidates[0]
+        for candidate in candidates[1:]:
+            if not matches:
+                break
+            matches = matches & candidate
+        return matches
+
+    def filter(self, image_data, query):
+        # Positions in image_data of the records matching query, in order
+        matches = self.search(query)
+        if matches is None:
+            return list(range(len(image_data)))
+        # One pass over the loaded records; app.py hands in a new list on every rerun, so a position map
+        # built for one list would be rebuilt at the same cost on the next
+        return [index for index, record in enumerate(image_data) if record['key'] in matches]
@@ -0,0 +1,51 @@
+DEFAULT_OVERLAY_SETTINGS = {
+    'font_path': "Lato-Regular.ttf",
+    'font_size': 24,
+    'text_color': '#000000',
+    'wrap_width_percentage': 80,
+    'line_spacing_percentage': 100,
+    'stroke_width': 0,
+    'stroke_color': '#FFFFFF',
+    'tint': False,
+    'include_overlay': True,
+    'overlay_position': "Bottom",
+    'brightness': 0,
+    'uniform_padding_checkbox': False,
+    'uniform_padding': 3.0,
+    'vertical_padding': 3.0,
+    'horizontal_padding': 3.0,
+    'overlay_margin': 10,
+    'tint_color': '#FFFFFF',
+    'tint_opacity': 0.5,
+    'watermark_size': 24
+}
+
+
+FONT_FILES = {
+    "Lato-Regular.ttf",
+    "Merriweather-Regular.ttf",
+    "Orbitron-SemiBold.ttf",
+    "Pacifico-Regular.ttf",
+    "PlayfairDisplaySC-Bold.ttf",
+    "Poppins-Bold.ttf"
+}
+
+
+def make_settings(overrides=None, **kwargs):
+    # Full overlay settings for a headless render: the defaults with any overrides applied on top
+    settings = DEFAULT_OVERLAY_SETTINGS.copy()
+    overrides = dict(overrides or {}, **kwargs)
+    for key, value in overrides.items():
+        if key not in DEFAULT_OVERLAY_SETTINGS:
+            raise KeyError(f"Unknown overlay setting: {key}")
+        # Coerce to the type of the default so values parsed from text behave like widget values
+        default = DEFAULT_OVERLAY_SETTINGS[key]
+        if isinstance(default, bool) and isinstance(value, str):
+            value = value.strip().lower() in ('1', 'true', 'yes', 'on')
+        elif not isinstance(default, str):
+            value = type(default)(value)
+        settings[key] = value
+    # Uniform padding drives both sides, as in the UI when non-uniform padding is off
+    if 'uniform_padding' in overrides and not settings['uniform_padding_checkbox']:
+        settings['vertical_padding'] = settings['horizontal_padding'] = settings['uniform_padding']
+    return settings
@@ -0,0 +1,188 @@
+import io
+import os
+import mmap
+import shutil
+import struct
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+
+# ZIP uploads larger than this are copied to a temporary file and memory-mapped rather than read from memory.
+# Files opened from disk are always mapped in place.
+SPOOL_THRESHOLD_BYTES = int(os.environ.get('PROMPTMARK_SPOOL_THRESHOLD_BYTES', 64 * 1024 * 1024))
+# Where spooled uploads go; empty for the system temporary directory
+SPOOL_DIR = os.environ.get('PROMPTMARK_SPOOL_DIR', '') or None
+
+# ZIPs inside ZIPs are listed down to this many levels
+NESTED_ZIP_DEPTH = int(os.environ.get('PROMPTMARK_NESTED_ZIP_DEPTH', 2))
+
+# Parsed archives of recent uploads, so reruns reuse them instead of reading the central directory again.
+# Archives read from memory keep their upload's bytes alive and count against the budget; mapped ones don't.
+ARCHIVE_CACHE_SIZE = 16
+ARCHIVE_CACHE_BUDGET_BYTES = int(os.environ.get('PROMPTMARK_ARCHIVE_CACHE_BUDGET_BYTES', 256 * 1024 * 1024))
+
+# Content keys remembered by upload identity, so reruns don't read and hash uploads they have seen before
+CONTENT_KEY_CACHE_SIZE = 100_000
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+_archives = OrderedDict()
+_archives_size = 0
+_archives_lock = threading.Lock()
+_content_keys = OrderedDict()
+_content_keys_lock = threading.Lock()
+
+
+class FileSource:
+    # Reference to an image file that is read again whenever its bytes are needed, instead of keeping them.
+    # identity stays the same across reruns for the same Streamlit upload, and is None for other files.
+    def __init__(self, file):
+        self.file = file
+        upload_id = getattr(file, 'file_id', None)
+        self.identity = None if upload_id is None else (upload_id, None, None, getattr(file, 'size', None))
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+
+class ZipMemberSource:
+    # Reference to one member of a ZIP; every member of an archive shares the same open ZipFile.
+    # identity names the member within its upload, or is None when the upload has no file_id.
+    def __init__(self, archive, name, identity=None):
+        self.archive = archive
+        self.name = name
+        self.identity = identity
+
+    def read(self):
+        return self.archive.read(self.name)
+
+
+class MappedFile:
+    # Read-only file object over a buffer such as a memory map. Each read copies only the bytes asked for,
+    # so a ZipFile on top of it never holds more than the member being read.
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        self.position = 0
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = max(0, offset)
+        return self.position
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else min(len(self.view), self.position + size)
+        data = self.view[self.position:end].tobytes()
+        self.position = max(self.position, end)
+        return data
+
+
+def spool(stream):
+    # Copies stream to an unnamed temporary file and maps it. The mapping keeps the file alive once the file
+    # object is gone, and its pages are reclaimable page cache rather than process memory.
+    with tempfile.TemporaryFile(dir=SPOOL_DIR) as spooled:
+        shutil.copyfileobj(stream, spooled, 1024 * 1024)
+        spooled.flush()
+        return mmap.mmap(spooled.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def upload_buffer(file):
+    # The whole of a ZIP upload as a buffer: files on disk are mapped in place, large uploads are spooled,
+    # and small ones use the upload's own bytes. getvalue() on a BytesIO returns its bytes without a copy.
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        pass
+    file.seek(0, io.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    if size > SPOOL_THRESHOLD_BYTES:
+        return spool(file)
+    return file.getvalue() if hasattr(file, 'getvalue') else file.read()
+
+
+def member_buffer(archive, buffer, info):
+    # A nested ZIP stored without compression is a slice of its parent's buffer and is used in place.
+    # A compressed one is always inflated into a spooled file, never into memory: the cached archive would
+    # keep those bytes alive for as long as the upload is cached, once for every nested ZIP it holds.
+    if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+        header = bytes(memoryview(buffer)[info.header_offset:info.header_offset + 30])
+        if len(header) < 30 or not header.startswith(LOCAL_HEADER_SIGNATURE):
+            raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        start = info.header_offset + 30 + name_length + extra_length
+        return memoryview(buffer)[start:start + info.compress_size]
+    with archive.open(info) as member:
+        return spool(member)
+
+
+def list_images(buffer, prefix='', depth=0, upload_id=None):
+    # (source, name) for every image in the ZIP in buffer, in archive order. Images inside nested ZIPs are
+    # named after the path of the ZIP they came from; nested ZIPs that can't be read, or are empty, are skipped.
+    archive = zipfile.ZipFile(MappedFile(buffer))
+    images = []
+    for info in archive.infolist():
+        name = info.filename
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            identity = None if upload_id is None else (upload_id, prefix + name, info.CRC, info.file_size)
+            images.append((ZipMemberSource(archive, name, identity), prefix + name))
+        elif name.lower().endswith('.zip') and depth < NESTED_ZIP_DEPTH:
+            try:
+                images.extend(list_images(member_buffer(archive, buffer, info), f"{prefix}{name}/", depth + 1, upload_id))
+            except (zipfile.BadZipFile, NotImplementedError, RuntimeError, ValueError):
+                continue
+    return images
+
+
+def archive_images(file):
+    # The images of a ZIP upload, parsed once per upload. Streamlit hands each rerun a new file object for
+    # the same upload, and its file_id is what stays the same; other files are parsed on every call.
+    global _archives_size
+    upload_id = getattr(file, 'file_id', None)
+    if upload_id is not None:
+        with _archives_lock:
+            entry = _archives.get(upload_id)
+            if entry is not None:
+                _archives.move_to_end(upload_id)
+                return entry[0]
+    buffer = upload_buffer(file)
+    images = list_images(buffer, upload_id=upload_id)
+    if upload_id is not None:
+        size = 0 if isinstance(buffer, mmap.mmap) else len(buffer)
+        with _archives_lock:
+            if upload_id not in _archives:
+                _archives[upload_id] = (images, size)
+                _archives_size += size
+            while len(_archives) > 1 and (len(_archives) > ARCHIVE_CACHE_SIZE or _archives_size > ARCHIVE_CACHE_BUDGET_BYTES):
+                _archives_size -= _archives.popitem(last=False)[1][1]
+    return images
+
+
+def cached_content_key(identity):
+    if identity is None:
+        return None
+    with _content_keys_lock:
+        key = _content_keys.get(identity)
+        if key is not None:
+            _content_keys.move_to_end(identity)
+        return key
+
+
+def remember_content_key(identity, key):
+    if identity is None:
+        return
+    with _content_keys_lock:
+        _content_keys[identity] = key
+        while len(_content_keys) > CONTENT_KEY_CACHE_SIZE:
+            _content_keys.popitem(last=False)
@@ -0,0 +1,136 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+
+# Shared by every session and server process on the machine; an empty path turns the store off
+STORE_PATH = os.environ.get('PROMPTMARK_STORE_PATH', os.path.join(os.path.expanduser('~'), '.cache', 'promptmark', 'ingest.sqlite3'))
+STORE_BUDGET_BYTES = int(os.environ.get('PROMPTMARK_STORE_BUDGET_BYTES', 1024 * 1024 * 1024))
+# Eviction trims down to this fraction of the budget so it doesn't run again on the very next insert
+STORE_EVICT_TO = 0.9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT NOT NULL,
+    encoder TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    description TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    thumbnail TEXT NOT NULL,
+    thumbnail_mime TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    dhash TEXT,
+    PRIMARY KEY (key, encoder)
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+"""
+
+_store = None
+_store_failed = False
+_store_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+class IngestStore:
+    # Ingest results on disk, keyed by content hash and thumbnail encoder. SQLite in WAL mode lets any number
+    # of Streamlit worker processes read concurrently while writers queue on the busy timeout.
+
+    def __init__(self, path=STORE_PATH, budget_bytes=STORE_BUDGET_BYTES):
+        self.path = path
+        self.budget_bytes = budget_bytes
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self.connection()
+        connection.executescript(SCHEMA)
+        # Stores created before near-duplicate hashes were recorded gain the column; their rows stay NULL
+        if 'dhash' not in {row[1] for row in connection.execute("PRAGMA table_info(entries)")}:
+            try:
+                connection.execute("ALTER TABLE entries ADD COLUMN dhash TEXT")
+            except sqlite3.OperationalError:
+                # Another process added it first
+                pass
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads, and Streamlit runs each session on its own
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def get_many(self, keys, encoder):
+        # Returns {key: entry} for the keys found, marking them as recently used
+        connection = self.connection()
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = connection.execute(
+                f"SELECT key, description, job_id, thumbnail, thumbnail_mime, dhash FROM entries "
+                f"WHERE encoder = ? AND key IN ({','.join('?' * len(batch))})", [encoder, *batch])
+            for key, description, job_id, thumbnail, thumbnail_mime, dhash in rows:
+                # Hashes are stored as hex, since SQLite integers are signed 64-bit
+                found[key] = {'description': description, 'job_id': job_id, 'thumbnail': thumbnail, 'thumbnail_mime': thumbnail_mime,
+                              'dhash': None if dhash is None else int(dhash, 16)}
+        if found:
+            connection.executemany("UPDATE entries SET last_used = ? WHERE key = ? AND encoder = ?",
+                                   [(time.time(), key, encoder) for key in found])
+        return found
+
+    def put_many(self, entries, encoder):
+        # entries maps key -> (filename, entry); existing rows are left as they are
+        if not entries:
+            return
+        now = time.time()
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT OR IGNORE INTO entries (key, encoder, filename, description, job_id, thumbnail, thumbnail_mime, size, last_used, dhash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(key, encoder, filename, entry['description'], entry['job_id'], entry['thumbnail'], entry['thumbnail_mime'],
+                  len(entry['thumbnail']) + len(entry['description']), now, f"{entry['dhash']:016x}") for key, (filename, entry) in entries.items()])
+            self.evict(connection)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def evict(self, connection):
+        # Drop least recently used rows once the stored thumbnails and descriptions exceed the budget
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.budget_bytes:
+            return
+        excess = total - int(self.budget_bytes * STORE_EVICT_TO)
+        doomed = []
+        for rowid, size in connection.execute("SELECT rowid, size FROM entries ORDER BY last_used"):
+            doomed.append((rowid,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany("DELETE FROM entries WHERE rowid = ?", doomed)
+
+    def size(self):
+        return self.connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+
+
+def get_store():
+    # One store per server process, or None when PROMPTMARK_STORE_PATH is empty. A store that can't be opened
+    # (read-only home, locked or corrupt database) is logged once and left off, so ingest falls back to the
+    # in-memory cache rather than failing every upload
+    global _store, _store_failed
+    if not STORE_PATH:
+        return None
+    with _store_lock:
+        if _store is None and not _store_failed:
+            try:
+                _store = IngestStore()
+            except (OSError, sqlite3.Error) as error:
+                logger.warning("Ingest store %s unavailable, continuing without it: %s", STORE_PATH, error)
+                _store_failed = True
+    return _store
@@ -0,0 +1,77 @@
+import io
+import os
+import base64
+from PIL import Image
+
+THUMBNAIL_SIZE = (100, 100)
+
+# How far above the target size the cheap reductions (JPEG scaled decoding, integer box reduce) may stop
+# before the final resample. Lower is faster; 2.0 is visually indistinguishable from a full-quality resample.
+THUMBNAIL_REDUCING_GAP = float(os.environ.get('PROMPTMARK_THUMBNAIL_REDUCING_GAP', 2.0))
+
+# Encoder name -> (Pillow format, MIME type). 'png8' is PNG with an adaptive 256 colour palette.
+THUMBNAIL_ENCODERS = {
+    'png': ('PNG', 'image/png'),
+    'png8': ('PNG', 'image/png'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+}
+MIME_EXTENSIONS = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/webp': 'webp'}
+
+# Thumbnails are PNG unless the deployment picks a smaller encoder; quality applies to JPEG and WebP
+THUMBNAIL_FORMAT = os.environ.get('PROMPTMARK_THUMBNAIL_FORMAT', 'png').lower()
+THUMBNAIL_QUALITY = int(os.environ.get('PROMPTMARK_THUMBNAIL_QUALITY', 80))
+
+
+def make_thumbnail(img, size=THUMBNAIL_SIZE, reducing_gap=None):
+    # img must be freshly opened and not yet loaded. JPEGs are then decoded by libjpeg straight at
+    # 1/2, 1/4 or 1/8 scale, and other formats are box-reduced by an integer factor before resampling,
+    # so the full-quality filter never runs at the source size.
+    reducing_gap = THUMBNAIL_REDUCING_GAP if reducing_gap is None else reducing_gap
+    draft_size = (int(size[0] * reducing_gap), int(size[1] * reducing_gap))
+    if img.format == 'JPEG':
+        img.draft('RGB', draft_size)
+    img.thumbnail(size, reducing_gap=reducing_gap)
+    return img
+
+
+def encode_thumbnail(img, encoder=None, quality=None):
+    # Returns the encoded bytes and their MIME type
+    encoder = THUMBNAIL_FORMAT if encoder is None else encoder
+    quality = THUMBNAIL_QUALITY if quality is None else quality
+    image_format, mime = THUMBNAIL_ENCODERS[encoder]
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+    buffer = io.BytesIO()
+    if encoder == 'png':
+        img.save(buffer, format=image_format)
+    elif encoder == 'png8':
+        img = img.convert('RGBA' if has_alpha else 'RGB').quantize(256, method=Image.Quantize.FASTOCTREE)
+        img.save(buffer, format=image_format, optimize=True)
+    elif encoder == 'jpeg':
+        img.convert('RGB').save(buffer, format=image_format, quality=quality, optimize=True)
+    else:
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+        img.save(buffer, format=image_format, quality=quality, method=4)
+    return buffer.getvalue(), mime
+
+
+def build_sprite_atlas(image_data, encoder=None, quality=None, columns=32, rows=32):
+    # Packs each distinct thumbnail into a grid of THUMBNAIL_SIZE cells, columns * rows per atlas image.
+    # Returns the encoded atlases and, per image key, (atlas index, x, y, width, height).
+    cell_width, cell_height = THUMBNAIL_SIZE
+    unique = list({data['key']: data for data in image_data}.values())
+    per_atlas = columns * rows
+    atlases = []
+    cells = {}
+    for start in range(0, len(unique), per_atlas):
+        chunk = unique[start:start + per_atlas]
+        atlas_rows = -(-len(chunk) // columns)
+        atlas = Image.new('RGBA', (min(columns, len(chunk)) * cell_width, atlas_rows * cell_height), (0, 0, 0, 0))
+        for i, data in enumerate(chunk):
+            thumb = Image.open(io.BytesIO(base64.b64decode(data['thumbnail']))).convert('RGBA')
+            x, y = (i % columns) * cell_width, (i // columns) * cell_height
+            atlas.paste(thumb, (x, y))
+            cells[data['key']] = (len(atlases), x, y, thumb.width, thumb.height)
+        encoded, mime = encode_thumbnail(atlas, encoder, quality)
+        atlases.append({'data': encoded, 'mime': mime})
+    return {'atlases': atlases, 'cells': cells}
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+# Stage timing is off unless PROMPTMARK_TRACE is set or it is switched on from the debug panel
+TRACE_ENABLED = os.environ.get("PROMPTMARK_TRACE", "") not in ("", "0")
+
+# Finished traces kept for the debug panel
+TRACE_HISTORY = int(os.environ.get("PROMPTMARK_TRACE_HISTORY", 20))
+
+# Every finished trace is logged here as one JSON line: "-" for stderr, a file path, or nowhere when empty
+TRACE_LOG = os.environ.get("PROMPTMARK_TRACE_LOG", "")
+
+# When set, the counters are rewritten to this JSON file after every trace. Streamlit serves files from a
+# static/ directory beside app.py at /app/static/ once server.enableStaticServing is set in .streamlit/config.toml,
+# so pointing this at static/metrics.json with that option on exposes them over HTTP.
+METRICS_PATH = os.environ.get("PROMPTMARK_METRICS_PATH", "")
+
+logger = logging.getLogger(__name__)
+if TRACE_LOG:
+    logger.addHandler(logging.StreamHandler() if TRACE_LOG == "-" else logging.FileHandler(TRACE_LOG))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# Metrics write failures are reported here rather than in the trace log
+metrics_logger = logging.getLogger("promptmark.metrics")
+
+NULL_SPAN = nullcontext()
+recent_traces = deque(maxlen=TRACE_HISTORY)
+counters = {}
+counters_lock = threading.Lock()
+metrics_lock = threading.Lock()
+# Each thread records into its own open trace
+local_state = threading.local()
+
+
+def enabled():
+    return TRACE_ENABLED
+
+
+def set_enabled(value):
+    global TRACE_ENABLED
+    TRACE_ENABLED = bool(value)
+
+
+def record(name, elapsed_ms):
+    with counters_lock:
+        counter = counters.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        counter['count'] += 1
+        counter['total_ms'] += elapsed_ms
+        counter['max_ms'] = max(counter['max_ms'], elapsed_ms)
+    current = getattr(local_state, 'trace', None)
+    if current is not None:
+        current['spans'].append((name, round(elapsed_ms, 3)))
+
+
+@contextmanager
+def timed_span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - start) * 1000)
+
+
+def span(name):
+    # Times one stage into the counters and the open trace. While tracing is off this is a flag
+    # check returning a shared no-op context, so spans can stay in the hot paths.
+    if not TRACE_ENABLED:
+        return NULL_SPAN
+    return timed_span(name)
+
+
+def timed(name):
+    # Decorator form of span for stages that are a whole function
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not TRACE_ENABLED:
+                return function(*args, **kwargs)
+            with timed_span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def open_trace(name, fields):
+    current = dict(fields, trace=name, spans=[])
+    local_state.trace = current
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        local_state.trace = None
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        record(name, elapsed_ms)
+        current['total_ms'] = round(elapsed_ms, 3)
+        current['time'] = time.time()
+        with counters_lock:
+            recent_traces.append(current)
+        if TRACE_LOG:
+            logger.info(json.dumps(current, default=str))
+        if METRICS_PATH:
+            write_metrics(METRICS_PATH)
+
+
+def trace(name, **fields):
+    # Groups the spans of one user-visible operation, such as a preview render, into a single record.
+    # Inside another trace it is timed as a span of that trace instead.
+    if not TRACE_ENABLED:
+        return NULL_SPAN
+    if getattr(local_state, 'trace', None) is not None:
+        return timed_span(name)
+    return open_trace(name, fields)
+
+
+def snapshot():
+    with counters_lock:
+        return list(recent_traces), {name: dict(counter) for name, counter in counters.items()}
+
+
+def reset():
+    with counters_lock:
+        recent_traces.clear()
+        counters.clear()
+
+
+def write_metrics(path):
+    # Written to a uniquely named file beside the target and renamed over it, so a scraper never reads a
+    # partial file. Traces finish on several threads at once; a failed write is logged, never raised into them.
+    _, current_counters = snapshot()
+    with metrics_lock:
+        temporary_path = None
+        try:
+            descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+            with os.fdopen(descriptor, 'w') as metrics_file:
+                json.dump({'time': time.time(), 'counters': current_counters}, metrics_file)
+            os.replace(temporary_path, path)
+        except OSError as error:
+            metrics_logger.warning("Could not write metrics to %s: %s", path, error)
+            if temporary_path is not None and os.path.exists(temporary_path):
+                os.unlink(temporary_path)
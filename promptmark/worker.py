@@ -0,0 +1,66 @@
+import time
+import threading
+from promptmark.render import RenderCancelled
+
+# Pause before each render starts, so a burst of setting changes collapses into one render
+RENDER_DEBOUNCE_SECONDS = 0.05
+
+
+class RenderWorker:
+    # Runs preview renders on a background thread, one at a time. Only the newest request matters:
+    # it replaces a request that has not started yet, and a render already running for older settings
+    # stops at its next stage. The thread exits when there is nothing left to render.
+    def __init__(self, debounce=RENDER_DEBOUNCE_SECONDS):
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.pending = None
+        self.rendering = False
+        self.thread = None
+        self.frame = None
+        self.frame_generation = 0
+        self.error = None
+
+    def submit(self, render, *args, **kwargs):
+        # render is called on the worker thread as render(*args, cancelled=..., **kwargs)
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, render, args, kwargs)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="promptmark-render", daemon=True)
+                self.thread.start()
+            return self.generation
+
+    def busy(self):
+        with self.condition:
+            return self.pending is not None or self.rendering
+
+    def latest(self):
+        # The most recent completed frame, the generation it was requested at, and the last render error
+        with self.condition:
+            return self.frame, self.frame_generation, self.error
+
+    def run(self):
+        while True:
+            time.sleep(self.debounce)
+            with self.condition:
+                if self.pending is None:
+                    self.rendering = False
+                    self.thread = None
+                    return
+                generation, render, args, kwargs = self.pending
+                self.pending = None
+                self.rendering = True
+            try:
+                frame = render(*args, cancelled=lambda: self.generation != generation, **kwargs)
+                error = None
+            except RenderCancelled:
+                continue
+            except Exception as render_error:
+                frame, error = None, render_error
+            with self.condition:
+                # A render that finished just before being superseded is still newer than the frame on screen
+                if generation > self.frame_generation:
+                    self.error = error
+                    if frame is not None:
+                        self.frame, self.frame_generation = frame, generation